@@ -0,0 +1,342 @@
+"""Офлайн-бенчмарк бота: синтетические гильдии и поддельный HTTP-слой Discord вместо сети.
+
+    python bench.py [--engine heap] [--reminders 5000] [--members 2000] [--latency 0.005] ...
+
+Меряет время старта на N напоминаниях, скорость отправки (напоминаний/с и ЛС/с), опоздание
+планировщика, пропускную способность хелперов БД и пиковую память. Результат печатается и
+дописывается строкой JSON с хэшем коммита в bench_output.txt — так прогоны сравниваются между
+коммитами. По умолчанию лимиты ЛС подняты, чтобы мерить сам код, а не бюджет Discord;
+с --dm-rate 40 видно поведение на боевых лимитах.
+"""
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import resource
+import tempfile
+import importlib
+import subprocess
+from datetime import datetime, timedelta, timezone
+from typing import Dict, List
+
+REPO = os.path.dirname(os.path.abspath(__file__))
+CHANNEL_ID = 900_000_000_000_000_001
+DM_CHANNEL_BASE = 800_000_000_000_000_000
+CHUNK_SIZE = 1000  # участников в одном GUILD_MEMBERS_CHUNK, как у Discord
+
+def parse_args() -> argparse.Namespace:
+    p = argparse.ArgumentParser(description="Офлайн-бенчмарк бота напоминаний")
+    p.add_argument("--engine", choices=("apscheduler", "heap"), default=os.getenv("SCHEDULER_ENGINE", "apscheduler"))
+    p.add_argument("--guilds", type=int, default=2)
+    p.add_argument("--members", type=int, default=2000, help="участников на гильдию")
+    p.add_argument("--roles", type=int, default=10, help="ролей на гильдию")
+    p.add_argument("--reminders", type=int, default=5000, help="напоминаний в БД для замера старта")
+    p.add_argument("--deliveries", type=int, default=20, help="сколько напоминаний отправить")
+    p.add_argument("--jitter-jobs", type=int, default=2000)
+    p.add_argument("--jitter-window", type=float, default=3.0, help="сек, по которым размазаны джобы")
+    p.add_argument("--db-ops", type=int, default=5000)
+    p.add_argument("--latency", type=float, default=0.005, help="сек на один HTTP-запрос")
+    p.add_argument("--ratelimit", type=float, default=0.01, help="доля ответов 429")
+    p.add_argument("--retry-after", type=float, default=0.05)
+    p.add_argument("--dm-rate", type=float, default=2000)
+    p.add_argument("--dm-open-rate", type=float, default=2000)
+    p.add_argument("--dm-concurrency", type=int, default=64)
+    p.add_argument("--coalesce", action="store_true", help="COALESCE_DELIVERIES=1")
+    p.add_argument("--seed", type=int, default=1)
+    p.add_argument("--output", default=os.path.join(REPO, "bench_output.txt"))
+    return p.parse_args()
+
+def peak_rss_mb() -> float:
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024  # Linux: КБ
+
+def percentile(values: List[float], q: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+# --------- Поддельный Discord ----------
+class FakeHTTP:
+    """Вместо discord.http.HTTPClient: каждый запрос — пауза latency (±50%), доля ответов
+    превращается в 429 (discord.RateLimited, как при max_ratelimit_timeout)."""
+
+    def __init__(self, latency: float, ratelimit: float, retry_after: float, rng: random.Random) -> None:
+        self.latency = latency
+        self.ratelimit = ratelimit
+        self.retry_after = retry_after
+        self.rng = rng
+        self.requests = 0
+        self.ratelimited = 0
+        self.dm_sent = 0
+        self.posts = 0
+        self._ids = iter(range(700_000_000_000_000_000, 10 ** 19))
+
+    async def _request(self) -> None:
+        self.requests += 1
+        await asyncio.sleep(self.latency * self.rng.uniform(0.5, 1.5))
+        if self.rng.random() < self.ratelimit:
+            self.ratelimited += 1
+            raise discord.RateLimited(self.retry_after)
+
+    async def start_private_message(self, user_id: int) -> dict:
+        await self._request()
+        return {"id": str(DM_CHANNEL_BASE + user_id), "type": 1, "recipients": []}
+
+    async def send_message(self, channel_id: int, *, params) -> dict:
+        await self._request()
+        if int(channel_id) >= DM_CHANNEL_BASE and int(channel_id) != CHANNEL_ID:
+            self.dm_sent += 1
+        else:
+            self.posts += 1
+        return {
+            "id": str(next(self._ids)),
+            "channel_id": str(channel_id),
+            "content": (params.payload or {}).get("content") or "",
+            "author": {"id": "1", "username": "bot", "discriminator": "0", "avatar": None, "bot": True},
+            "attachments": [],
+            "embeds": [],
+            "mentions": [],
+            "mention_roles": [],
+            "pinned": False,
+            "mention_everyone": False,
+            "tts": False,
+            "type": 0,
+            "flags": 0,
+            "timestamp": datetime.now(timezone.utc).isoformat(),
+            "edited_timestamp": None,
+        }
+
+    async def add_reaction(self, channel_id: int, message_id: int, emoji: str) -> None:
+        await self._request()
+
+    async def close(self) -> None:
+        pass
+
+def role_id(guild_id: int, index: int) -> int:
+    return guild_id * 1000 + index + 1
+
+def make_guilds(state, n_guilds: int, n_roles: int) -> List[int]:
+    ids = []
+    for g in range(n_guilds):
+        gid = 100_000 + g
+        data = {
+            "id": str(gid),
+            "name": f"bench-{g}",
+            "owner_id": "1",
+            "member_count": 0,
+            "features": [],
+            "emojis": [],
+            "stickers": [],
+            "roles": [{"id": str(gid), "name": "@everyone", "permissions": "1024", "position": 0, "color": 0,
+                       "hoist": False, "managed": False, "mentionable": False}]
+                     + [{"id": str(role_id(gid, r)), "name": f"role-{r}", "permissions": "0", "position": r + 1,
+                         "color": 0, "hoist": False, "managed": False, "mentionable": True} for r in range(n_roles)],
+            "channels": [{"id": str(CHANNEL_ID), "type": 0, "name": "reminders", "position": 0,
+                          "permission_overwrites": []}] if g == 0 else [],
+        }
+        state._add_guild(discord.Guild(data=data, state=state))
+        ids.append(gid)
+    return ids
+
+def make_members(gid: int, n_members: int, n_roles: int, rng: random.Random) -> List[dict]:
+    joined = datetime.now(timezone.utc).isoformat()
+    members = []
+    for i in range(n_members):
+        uid = gid * 10_000_000 + i + 1
+        roles = rng.sample(range(n_roles), k=min(n_roles, rng.randint(1, 3)))
+        members.append({
+            "user": {"id": str(uid), "username": f"u{uid}", "discriminator": "0", "avatar": None,
+                     "global_name": None, "bot": i % 100 == 0},
+            "roles": [str(role_id(gid, r)) for r in roles],
+            "joined_at": joined,
+            "deaf": False,
+            "mute": False,
+            "flags": 0,
+        })
+    return members
+
+def install_fake_chunker(state, members: Dict[int, List[dict]], latency: float) -> None:
+    """state.chunker отдаёт участников пачками через штатный парсер GUILD_MEMBERS_CHUNK,
+    т.е. ровно тем путём, что и gateway (индекс участников + discord.py)."""
+
+    async def chunker(guild_id: int, query: str = "", limit: int = 0, presences: bool = False, *, nonce=None) -> None:
+        rows = members.get(guild_id, [])
+        count = max(1, (len(rows) + CHUNK_SIZE - 1) // CHUNK_SIZE)
+        for i in range(count):
+            await asyncio.sleep(latency)
+            state.parsers["GUILD_MEMBERS_CHUNK"]({
+                "guild_id": str(guild_id),
+                "members": rows[i * CHUNK_SIZE:(i + 1) * CHUNK_SIZE],
+                "chunk_index": i,
+                "chunk_count": count,
+            })
+
+    state.chunker = chunker
+
+# --------- Замеры ----------
+def reminder_records(args: argparse.Namespace, guild_ids: List[int], rng: random.Random) -> List[tuple]:
+    now_iso = datetime.utcnow().isoformat()
+    records = []
+    for i in range(args.reminders):
+        gid = guild_ids[i % len(guild_ids)]
+        rid = role_id(gid, rng.randrange(args.roles))
+        if i % 5 == 0:
+            run_at = (datetime.utcnow() + timedelta(days=rng.randint(1, 30))).replace(second=0, microsecond=0)
+            records.append((gid, 1, "role", rid, None, f"bench {i}", "one", run_at.isoformat(), None, None,
+                            0, None, 1, now_iso, now_iso))
+        else:
+            days = ",".join(sorted(rng.sample(B.DAY_ORDER, k=rng.randint(1, 3)), key=B.DAY_ORDER.index))
+            records.append((gid, 1, "role", rid, None, f"bench {i}", "weekly", None, days,
+                            f"{rng.randrange(24):02d}:{rng.randrange(60):02d}", 0, None, 1, now_iso, now_iso))
+    return records
+
+async def bench_startup(client, args: argparse.Namespace, guild_ids: List[int], rng: random.Random) -> dict:
+    await B.db_init()
+    await B.db.run_write(lambda conn: conn.executemany(B.INSERT_REMINDER, reminder_records(args, guild_ids, rng)))
+    start = time.perf_counter()
+    await client.setup_hook()
+    loaded = await B.reminder_loader.load_all()
+    elapsed = time.perf_counter() - start
+    return {"startup_s": elapsed, "reminders_loaded": loaded, "schedule_per_s": loaded / elapsed}
+
+async def bench_delivery(args: argparse.Namespace, http: FakeHTTP) -> dict:
+    rows = await B.db_fetchall(
+        "SELECT id FROM reminders WHERE mode='weekly' AND active=1 ORDER BY id LIMIT ?", (args.deliveries,)
+    )
+    sent_before, requests_before, limited_before = http.dm_sent, http.requests, http.ratelimited
+    start = time.perf_counter()
+    await asyncio.gather(*(B.do_send(r["id"]) for r in rows))
+    elapsed = time.perf_counter() - start
+    dms = http.dm_sent - sent_before
+    return {
+        "delivery_s": elapsed,
+        "reminders_per_s": len(rows) / elapsed,
+        "dms": dms,
+        "dms_per_s": dms / elapsed,
+        "http_requests": http.requests - requests_before,
+        "http_429": http.ratelimited - limited_before,
+    }
+
+async def bench_jitter(args: argparse.Namespace) -> dict:
+    lateness: List[float] = []
+    done = asyncio.Event()
+
+    async def job(planned: float) -> None:
+        lateness.append(time.time() - planned)
+        if len(lateness) == args.jitter_jobs:
+            done.set()
+
+    base = time.time() + 0.5
+    for i in range(args.jitter_jobs):
+        planned = base + args.jitter_window * i / max(1, args.jitter_jobs)
+        B.scheduler.at(f"bench_{i}", datetime.fromtimestamp(planned, timezone.utc), job, planned, late_ok=True)
+    try:
+        await asyncio.wait_for(done.wait(), timeout=args.jitter_window + 30)
+    except asyncio.TimeoutError:
+        pass
+    ms = [x * 1000 for x in lateness]
+    return {
+        "jitter_fired": len(ms),
+        "jitter_p50_ms": percentile(ms, 0.5),
+        "jitter_p95_ms": percentile(ms, 0.95),
+        "jitter_max_ms": max(ms, default=0.0),
+    }
+
+async def bench_db(args: argparse.Namespace) -> dict:
+    ids = [r["id"] for r in await B.db_fetchall("SELECT id FROM reminders LIMIT ?", (args.db_ops,))] or [0]
+    start = time.perf_counter()
+    await asyncio.gather(*(B.db_fetchone("SELECT * FROM reminders WHERE id=?", (ids[i % len(ids)],)) for i in range(args.db_ops)))
+    reads = args.db_ops / (time.perf_counter() - start)
+
+    n = max(1, args.db_ops // 10)
+    start = time.perf_counter()
+    for i in range(n):
+        await B.db_execute("UPDATE reminders SET message=message WHERE id=?", (ids[i % len(ids)],))
+    writes = n / (time.perf_counter() - start)
+
+    start = time.perf_counter()
+    for i in range(args.db_ops):
+        B.write_behind.submit("UPDATE reminders SET message=message WHERE id=?", (ids[i % len(ids)],))
+    await B.write_behind.flush()
+    buffered = args.db_ops / (time.perf_counter() - start)
+    return {"db_reads_per_s": reads, "db_writes_per_s": writes, "db_write_behind_per_s": buffered}
+
+def git_revision() -> str:
+    try:
+        rev = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=REPO, capture_output=True, text=True).stdout.strip()
+        dirty = subprocess.run(["git", "status", "--porcelain", "--", "bot.py"], cwd=REPO, capture_output=True, text=True).stdout.strip()
+        return rev + ("+dirty" if dirty else "")
+    except OSError:
+        return "unknown"
+
+async def run(args: argparse.Namespace) -> dict:
+    rng = random.Random(args.seed)
+    client = B.bot
+    state = client._connection
+    http = FakeHTTP(args.latency, args.ratelimit, args.retry_after, rng)
+    client.http = state.http = http
+
+    result: dict = {"engine": args.engine, "guilds": args.guilds, "members": args.members, "roles": args.roles}
+    result["rss_base_mb"] = peak_rss_mb()
+    guild_ids = make_guilds(state, args.guilds, args.roles)
+    members = {gid: make_members(gid, args.members, args.roles, rng) for gid in guild_ids}
+    install_fake_chunker(state, members, args.latency)
+
+    result.update(await bench_startup(client, args, guild_ids, rng))
+    result["rss_after_startup_mb"] = peak_rss_mb()
+    result.update(await bench_delivery(args, http))
+    result["rss_after_delivery_mb"] = peak_rss_mb()
+    result.update(await bench_jitter(args))
+    result.update(await bench_db(args))
+    result["rss_peak_mb"] = peak_rss_mb()
+
+    B.scheduler.shutdown()
+    await B.retention.stop()
+    await B.outbox.stop()
+    await B.write_behind.close()
+    B.db.close()
+    return result
+
+def main() -> None:
+    global B, discord
+    args = parse_args()
+    os.environ.update({
+        "DISCORD_TOKEN": "bench",
+        "CHANNEL_ID": str(CHANNEL_ID),
+        "SCHEDULER_ENGINE": args.engine,
+        "DM_GLOBAL_RATE": str(args.dm_rate),
+        "DM_OPEN_RATE": str(args.dm_open_rate),
+        "DM_CONCURRENCY": str(args.dm_concurrency),
+        "COALESCE_DELIVERIES": "1" if args.coalesce else "0",
+        "HISTORY_RETENTION_DAYS": "0",
+        "METRICS_PORT": "0",
+        "OUTBOX_BACKOFF": str(args.retry_after),
+    })
+    sys.path.insert(0, REPO)
+    import discord
+    workdir = tempfile.TemporaryDirectory(prefix="reminder-bench-")
+    # БД бота лежит в текущем каталоге — работаем во временном
+    os.chdir(workdir.name)
+    try:
+        B = importlib.import_module("bot")
+        result = asyncio.run(run(args))
+    finally:
+        os.chdir(REPO)
+        workdir.cleanup()
+    result["revision"] = git_revision()
+    result["at"] = datetime.utcnow().isoformat(timespec="seconds")
+
+    width = max(len(k) for k in result)
+    for k, v in result.items():
+        print(f"{k:<{width}}  {v:.2f}" if isinstance(v, float) else f"{k:<{width}}  {v}")
+    with open(args.output, "a", encoding="utf-8") as f:
+        f.write(json.dumps(result, ensure_ascii=False) + "\n")
+
+B = None
+discord = None
+
+if __name__ == "__main__":
+    main()
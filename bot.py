@@ -1,12 +1,30 @@
+import io
 import os
+import csv
+import json
+import signal
 import sqlite3
 import asyncio
-from datetime import datetime, timedelta
-from typing import List, Optional, Tuple
+import threading
+import time
+import heapq
+import itertools
+import tempfile
+from array import array
+from collections import OrderedDict
+from contextlib import contextmanager
+from bisect import bisect_left, bisect_right
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from typing import AsyncIterator, Awaitable, Callable, Dict, Iterable, Iterator, List, Optional, Sequence, Set, Tuple, TypeVar
 
 import discord
+import numpy as np
+from aiohttp import web
 from discord.ext import commands
-from discord.ui import Select, View
+from discord.ui import Button, Select, View
+from apscheduler.events import EVENT_JOB_SUBMITTED, JobSubmissionEvent
+from apscheduler.jobstores.base import JobLookupError
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from apscheduler.triggers.date import DateTrigger
 from apscheduler.triggers.cron import CronTrigger
@@ -16,19 +34,319 @@ from dateutil import parser as dateparser
 TOKEN = os.getenv("DISCORD_TOKEN")
 CHANNEL_ID = int(os.getenv("CHANNEL_ID", "0"))  # канал для постов/реакций
 DB_FILE = "reminders.db"
+DB_READERS = int(os.getenv("DB_READERS", "4"))  # размер пула соединений-читателей
+DM_CONCURRENCY = int(os.getenv("DM_CONCURRENCY", "8"))            # одновременных отправок ЛС
+DM_GLOBAL_RATE = float(os.getenv("DM_GLOBAL_RATE", "40"))         # запросов/сек (глобальный лимит Discord — 50)
+DM_OPEN_RATE = float(os.getenv("DM_OPEN_RATE", "5"))              # открытий ЛС-каналов/сек (общий маршрут)
+DM_MAX_RETRIES = int(os.getenv("DM_MAX_RETRIES", "3"))            # повторов одного получателя после 429
+DM_MAX_RATELIMIT_WAIT = float(os.getenv("DM_MAX_RATELIMIT_WAIT", "30"))  # дольше — 429 отдаётся нам, а не ждётся внутри discord.py
+DM_PROGRESS_EVERY = 500
+OUTBOX_WORKERS = int(os.getenv("OUTBOX_WORKERS", str(DM_CONCURRENCY)))  # воркеров, разбирающих outbox
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", "5"))         # попыток на получателя до статуса 'failed'
+OUTBOX_BACKOFF = float(os.getenv("OUTBOX_BACKOFF", "5"))                 # сек, удваивается с каждой попыткой
+ACK_EMOJI = "✅"
+ACK_WINDOW_MINUTES = 5  # ACK публикуется за столько минут до отправки
+COALESCE_DELIVERIES = os.getenv("COALESCE_DELIVERIES", "0") == "1"  # склеивать одновременные напоминания
+COALESCE_WINDOW = float(os.getenv("COALESCE_WINDOW", "1.0"))          # сек сбора одновременных срабатываний
+COALESCE_MAX_LENGTH = 1900                                            # лимит Discord — 2000 символов
+SCHEDULER_ENGINE = os.getenv("SCHEDULER_ENGINE", "apscheduler")  # 'apscheduler' | 'heap'
+CATCHUP_POLICY = os.getenv("CATCHUP_POLICY", "fire-once")                # 'skip' | 'fire-once' | 'fire-all' по умолчанию
+CATCHUP_MAX_AGE_HOURS = float(os.getenv("CATCHUP_MAX_AGE_HOURS", "168"))  # старше — не догоняем
+CATCHUP_INTERVAL = float(os.getenv("CATCHUP_INTERVAL", "2"))             # сек между догоняющими отправками
+CATCHUP_OUTBOX_LIMIT = int(os.getenv("CATCHUP_OUTBOX_LIMIT", "100"))     # ждём, пока живая очередь ЛС не станет меньше
+GUILD_CACHE_SIZE = int(os.getenv("GUILD_CACHE_SIZE", "1000"))  # гильдий в LRU-кэше настроек
+REMINDER_LOAD_BATCH = int(os.getenv("REMINDER_LOAD_BATCH", "500"))  # строк за один шаг загрузки
+PAGE_SIZE = int(os.getenv("PAGE_SIZE", "20"))                  # строк на странице list_reminders/history
+EXPORT_BATCH = int(os.getenv("EXPORT_BATCH", "1000"))          # строк за один шаг выгрузки !export
+MEMBER_INDEX_WAIT = float(os.getenv("MEMBER_INDEX_WAIT", "60"))  # сек ожидания чанков участников перед отправкой
+HISTORY_RETENTION_DAYS = float(os.getenv("HISTORY_RETENTION_DAYS", "90"))  # сырые строки history старше — удаляются (0 — хранить всё)
+RETENTION_INTERVAL = float(os.getenv("RETENTION_INTERVAL", "3600"))       # сек между проходами очистки
+RETENTION_BATCH = int(os.getenv("RETENTION_BATCH", "500"))                # строк за одну транзакцию удаления
+VACUUM_PAGES = int(os.getenv("VACUUM_PAGES", "256"))                      # страниц за один шаг incremental_vacuum
+WRITE_BEHIND_INTERVAL = float(os.getenv("WRITE_BEHIND_INTERVAL", "1.0"))  # сек между групповыми коммитами
+WRITE_BEHIND_MAX_BATCH = int(os.getenv("WRITE_BEHIND_MAX_BATCH", "200"))   # при таком размере буфера коммитим сразу
+FORECAST_HORIZON_DAYS = int(os.getenv("FORECAST_HORIZON_DAYS", "7"))  # горизонт !forecast по умолчанию
+FORECAST_TOP = int(os.getenv("FORECAST_TOP", "10"))                    # сколько горячих минут показывать
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))  # порт /metrics в формате Prometheus (0 — не поднимать)
+
+T = TypeVar("T")
+
+# --------- Метрики ----------
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0)
+
+class Counter:
+    __slots__ = ("value",)
+
+    def __init__(self) -> None:
+        self.value = 0.0
+
+    def inc(self, amount: float = 1.0) -> None:
+        self.value += amount
+
+class Histogram:
+    """Гистограмма с фиксированными границами: observe — один bisect и два сложения."""
+
+    __slots__ = ("bounds", "counts", "sum", "count")
+
+    def __init__(self, bounds: Sequence[float] = LATENCY_BUCKETS) -> None:
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)  # последний — +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q: float) -> Optional[float]:
+        """Верхняя граница корзины, в которую попадает квантиль q (оценка сверху)."""
+        if not self.count:
+            return None
+        need = q * self.count
+        seen = 0
+        for bound, n in zip(self.bounds, self.counts):
+            seen += n
+            if seen >= need:
+                return bound
+        return float("inf")
+
+class Metrics:
+    """Счётчики, гистограммы и гейджи в памяти процесса. На горячем пути — поиск в dict по
+    (имя, метки); объект метрики можно взять один раз и держать у себя. render() отдаёт
+    текстовый формат Prometheus."""
+
+    def __init__(self) -> None:
+        self._counters: Dict[Tuple[str, Tuple[Tuple[str, str], ...]], Counter] = {}
+        self._histograms: Dict[Tuple[str, Tuple[Tuple[str, str], ...]], Histogram] = {}
+        self._gauges: Dict[str, Callable[[], float]] = {}
+        self._routes: Dict[str, Callable[[web.Request], Awaitable[web.StreamResponse]]] = {}
+        self._runner: Optional[web.AppRunner] = None
+
+    def counter(self, name: str, **labels: str) -> Counter:
+        key = (name, tuple(sorted(labels.items())))
+        c = self._counters.get(key)
+        if c is None:
+            c = self._counters[key] = Counter()
+        return c
+
+    def histogram(self, name: str, **labels: str) -> Histogram:
+        key = (name, tuple(sorted(labels.items())))
+        h = self._histograms.get(key)
+        if h is None:
+            h = self._histograms[key] = Histogram()
+        return h
+
+    def gauge(self, name: str, fn: Callable[[], float]) -> None:
+        """Гейдж считается при чтении: fn() вызывается из render()."""
+        self._gauges[name] = fn
+
+    @contextmanager
+    def timer(self, name: str, **labels: str) -> Iterator[None]:
+        h = self.histogram(name, **labels)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            h.observe(time.perf_counter() - start)
+
+    def gauge_value(self, name: str) -> float:
+        return self._gauges[name]()
+
+    def counters(self, name: str) -> Dict[Tuple[Tuple[str, str], ...], float]:
+        return {labels: c.value for (n, labels), c in self._counters.items() if n == name}
+
+    def histograms(self, name: str) -> Dict[Tuple[Tuple[str, str], ...], Histogram]:
+        return {labels: h for (n, labels), h in self._histograms.items() if n == name}
+
+    @staticmethod
+    def _labels(labels: Iterable[Tuple[str, str]]) -> str:
+        inner = ",".join(f'{k}="{v}"' for k, v in labels)
+        return "{" + inner + "}" if inner else ""
+
+    def render(self) -> str:
+        lines: List[str] = []
+        typed: Set[str] = set()
+        for (name, labels), c in sorted(self._counters.items()):
+            if name not in typed:
+                typed.add(name)
+                lines.append(f"# TYPE {name} counter")
+            lines.append(f"{name}{self._labels(labels)} {c.value:g}")
+        for (name, labels), h in sorted(self._histograms.items(), key=lambda kv: kv[0]):
+            if name not in typed:
+                typed.add(name)
+                lines.append(f"# TYPE {name} histogram")
+            cumulative = 0
+            for bound, n in zip(h.bounds, h.counts):
+                cumulative += n
+                lines.append(f"{name}_bucket{self._labels(labels + (('le', f'{bound:g}'),))} {cumulative}")
+            lines.append(f"{name}_bucket{self._labels(labels + (('le', '+Inf'),))} {h.count}")
+            lines.append(f"{name}_sum{self._labels(labels)} {h.sum:g}")
+            lines.append(f"{name}_count{self._labels(labels)} {h.count}")
+        for name, fn in sorted(self._gauges.items()):
+            try:
+                value = fn()
+            except Exception:
+                continue
+            lines.append(f"# TYPE {name} gauge")
+            lines.append(f"{name} {value:g}")
+        return "\n".join(lines) + "\n"
+
+    async def _handle(self, request: web.Request) -> web.Response:
+        return web.Response(text=self.render(), content_type="text/plain", charset="utf-8")
+
+    def route(self, path: str, handler: Callable[[web.Request], Awaitable[web.StreamResponse]]) -> None:
+        """Дополнительный GET-маршрут на том же порту (до serve)."""
+        self._routes[path] = handler
+
+    async def serve(self, host: str, port: int) -> None:
+        app = web.Application()
+        app.router.add_get("/metrics", self._handle)
+        for path, handler in self._routes.items():
+            app.router.add_get(path, handler)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, host, port).start()
+
+    async def close(self) -> None:
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+metrics = Metrics()
 
 # --------- Интенты ----------
 intents = discord.Intents.default()
 intents.message_content = True
-intents.members = True
+intents.members = True  # нужен для чанков и событий участников; сам кэш участников выключен (см. MemberIndex)
 intents.guilds = True
 
-bot = commands.Bot(command_prefix="!", intents=intents)
-scheduler = AsyncIOScheduler()
+class ReminderBot(commands.Bot):
+    """Бот с жизненным циклом фоновых подсистем: запуск в setup_hook, аккуратная остановка в close."""
+
+    def dispatch(self, event_name: str, /, *args, **kwargs) -> None:
+        # ответы мастеру раздаются синхронно, как это делал wait_for
+        if event_name == "message":
+            wizard_sessions.route(args[0])
+        super().dispatch(event_name, *args, **kwargs)
+
+    async def setup_hook(self) -> None:
+        # один раз за процесс; on_ready повторяется после каждого переподключения
+        await db_init()
+        await ack_index.load()
+        scheduler.start()
+        write_behind.start()
+        await outbox.start()  # дорассылка того, что не успели до остановки
+        retention.start()
+        if METRICS_PORT:
+            await metrics.serve(METRICS_HOST, METRICS_PORT)
+        member_index.install(self._connection)
+        try:
+            asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, lambda: asyncio.ensure_future(self.close()))
+        except (NotImplementedError, RuntimeError):
+            pass  # Windows
+
+    async def close(self) -> None:
+        if scheduler.running:
+            scheduler.shutdown()
+        try:
+            await retention.stop()
+            await metrics.close()
+            await outbox.stop()
+            await super().close()
+        finally:
+            # всё, что успели поставить в буфер, должно попасть на диск
+            await write_behind.close()
+            db.close()
+
+bot = ReminderBot(
+    command_prefix="!",
+    intents=intents,
+    max_ratelimit_timeout=DM_MAX_RATELIMIT_WAIT,
+    member_cache_flags=discord.MemberCacheFlags.none(),
+    chunk_guilds_at_startup=False,
+)
 
 # --------- База данных ----------
-def db_init() -> None:
-    conn = sqlite3.connect(DB_FILE)
+class Database:
+    """Долгоживущие соединения SQLite в режиме WAL: один поток-писатель и пул читателей.
+    Запросы выполняются вне event loop, наружу отдаётся awaitable API."""
+
+    def __init__(self, path: str, readers: int = 4) -> None:
+        self.path = path
+        self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db-writer")
+        self._readers = ThreadPoolExecutor(max_workers=max(1, readers), thread_name_prefix="db-reader")
+        self._local = threading.local()
+        self._conns: List[sqlite3.Connection] = []
+        self._conns_lock = threading.Lock()
+        self._write_latency = metrics.histogram("bot_db_seconds", op="write")
+        self._read_latency = metrics.histogram("bot_db_seconds", op="read")
+
+    def _connection(self, readonly: bool) -> sqlite3.Connection:
+        # у каждого потока пула своё соединение; prepared statements живут в его кэше
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, check_same_thread=False, cached_statements=256)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA busy_timeout=5000")
+            if readonly:
+                conn.execute("PRAGMA query_only=1")
+            else:
+                conn.execute("PRAGMA journal_mode=WAL")
+                conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+            with self._conns_lock:
+                self._conns.append(conn)
+        return conn
+
+    def _write(self, fn: Callable[[sqlite3.Connection], T]) -> T:
+        conn = self._connection(readonly=False)
+        with conn:  # commit или rollback одной транзакцией
+            return fn(conn)
+
+    def _read(self, fn: Callable[[sqlite3.Connection], T]) -> T:
+        return fn(self._connection(readonly=True))
+
+    async def run_write(self, fn: Callable[[sqlite3.Connection], T]) -> T:
+        """Выполняет fn(conn) в потоке-писателе внутри одной транзакции."""
+        start = time.perf_counter()
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self._writer, self._write, fn)
+        finally:
+            self._write_latency.observe(time.perf_counter() - start)
+
+    async def run_read(self, fn: Callable[[sqlite3.Connection], T]) -> T:
+        """Выполняет fn(conn) на одном из соединений-читателей."""
+        start = time.perf_counter()
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self._readers, self._read, fn)
+        finally:
+            self._read_latency.observe(time.perf_counter() - start)
+
+    async def execute(self, query: str, params: Tuple = ()) -> int:
+        return await self.run_write(lambda conn: conn.execute(query, params).lastrowid)
+
+    async def fetchall(self, query: str, params: Tuple = ()) -> List[sqlite3.Row]:
+        return await self.run_read(lambda conn: conn.execute(query, params).fetchall())
+
+    async def fetchone(self, query: str, params: Tuple = ()) -> Optional[sqlite3.Row]:
+        return await self.run_read(lambda conn: conn.execute(query, params).fetchone())
+
+    def close(self) -> None:
+        self._writer.shutdown(wait=True)
+        self._readers.shutdown(wait=True)
+        with self._conns_lock:
+            for conn in self._conns:
+                conn.close()
+            self._conns.clear()
+
+db = Database(DB_FILE, DB_READERS)
+
+# --------- Миграции схемы ----------
+# Версия схемы хранится в PRAGMA user_version; каждая миграция применяется один раз
+# в собственной транзакции. Новые изменения схемы — только новой миграцией в конце списка.
+def _migration_1_base(conn: sqlite3.Connection) -> None:
     c = conn.cursor()
     c.execute(
         """CREATE TABLE IF NOT EXISTS reminders (
@@ -65,33 +383,312 @@ def db_init() -> None:
             UNIQUE(guild_id, user_id)
         )"""
     )
-    conn.commit()
-    conn.close()
+    c.execute(
+        """CREATE TABLE IF NOT EXISTS ack_messages (
+            message_id INTEGER PRIMARY KEY,  -- ACK-сообщение в канале
+            reminder_id INTEGER NOT NULL,
+            created_at TEXT NOT NULL
+        )"""
+    )
+    c.execute(
+        """CREATE TABLE IF NOT EXISTS ack_reactions (
+            message_id INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            PRIMARY KEY (message_id, user_id)
+        ) WITHOUT ROWID"""
+    )
+    c.execute(
+        """CREATE TABLE IF NOT EXISTS pending_deliveries (
+            reminder_id INTEGER NOT NULL,
+            deliver_at TEXT NOT NULL,        -- ISO, UTC (фаза «отправка»)
+            ack_message_id INTEGER,          -- ACK, опубликованный в фазе «ACK»
+            created_at TEXT NOT NULL,
+            PRIMARY KEY (reminder_id, deliver_at)
+        )"""
+    )
+
+def _migration_2_indexes(conn: sqlite3.Connection) -> None:
+    c = conn.cursor()
+    # list_reminders: guild_id + active, сортировка по id
+    c.execute("CREATE INDEX IF NOT EXISTS idx_reminders_guild_active ON reminders(guild_id, active, id)")
+    # load_all_reminders: только активные
+    c.execute("CREATE INDEX IF NOT EXISTS idx_reminders_active ON reminders(id) WHERE active=1")
+    # history: guild_id прямо в строке, чтобы не джойнить reminders и не сортировать всю таблицу
+    c.execute("ALTER TABLE history ADD COLUMN guild_id INTEGER")
+    c.execute("UPDATE history SET guild_id=(SELECT r.guild_id FROM reminders r WHERE r.id=history.reminder_id)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_history_guild_sent ON history(guild_id, sent_at)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_history_reminder_sent ON history(reminder_id, sent_at)")
 
-def db_execute(query: str, params: Tuple = ()) -> None:
-    conn = sqlite3.connect(DB_FILE)
+def _migration_3_updated_at(conn: sqlite3.Connection) -> None:
     c = conn.cursor()
-    c.execute(query, params)
-    conn.commit()
-    conn.close()
+    # водяной знак для догрузки изменений после переподключения
+    c.execute("ALTER TABLE reminders ADD COLUMN updated_at TEXT")
+    c.execute("UPDATE reminders SET updated_at=created_at")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_reminders_updated ON reminders(updated_at, id)")
 
-def db_fetchall(query: str, params: Tuple = ()) -> List[sqlite3.Row]:
-    conn = sqlite3.connect(DB_FILE)
-    conn.row_factory = sqlite3.Row
+def _migration_4_outbox(conn: sqlite3.Connection) -> None:
     c = conn.cursor()
-    c.execute(query, params)
-    rows = c.fetchall()
-    conn.close()
-    return rows
-
-def db_fetchone(query: str, params: Tuple = ()) -> Optional[sqlite3.Row]:
-    conn = sqlite3.connect(DB_FILE)
-    conn.row_factory = sqlite3.Row
+    c.execute(
+        """CREATE TABLE IF NOT EXISTS delivery_batches (
+            batch_key TEXT PRIMARY KEY,      -- '<rid>:<ack_msg_id>' или '<rid>@<минута>', через '+' при склейке
+            payload TEXT NOT NULL,           -- JSON: по напоминанию reminder_id, guild_id, ack_message_id, reacted
+            created_at TEXT NOT NULL
+        )"""
+    )
+    c.execute(
+        """CREATE TABLE IF NOT EXISTS outbox (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            batch_key TEXT NOT NULL,
+            user_id INTEGER NOT NULL,
+            reminder_ids TEXT NOT NULL,      -- '1,2' — чьи тексты в этом ЛС
+            content TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'pending',  -- 'pending' | 'sent' | 'forbidden' | 'failed'
+            attempts INTEGER NOT NULL DEFAULT 0,
+            UNIQUE(batch_key, user_id)       -- ключ дедупликации
+        )"""
+    )
+
+def _migration_5_catchup(conn: sqlite3.Connection) -> None:
+    c = conn.cursor()
+    c.execute("ALTER TABLE reminders ADD COLUMN last_fired_at TEXT")   # время последней отправки (UTC)
+    c.execute("ALTER TABLE reminders ADD COLUMN catchup_policy TEXT")  # NULL — CATCHUP_POLICY
+    c.execute("UPDATE reminders SET last_fired_at=(SELECT max(h.sent_at) FROM history h WHERE h.reminder_id=reminders.id)")
+
+def _migration_6_history_facts(conn: sqlite3.Connection) -> None:
     c = conn.cursor()
-    c.execute(query, params)
-    row = c.fetchone()
-    conn.close()
-    return row
+    # факты доставки — отдельными колонками вместо строки details
+    c.execute("ALTER TABLE history ADD COLUMN ack_message_id INTEGER")
+    c.execute("ALTER TABLE history ADD COLUMN reacted INTEGER")
+    c.execute("ALTER TABLE history ADD COLUMN recipients INTEGER")
+    c.execute("ALTER TABLE history ADD COLUMN dm_failed INTEGER")
+    c.execute(
+        """UPDATE history SET
+               ack_message_id=CAST(NULLIF(substr(details, 12, instr(details, ' ') - 12), 'None') AS INTEGER),
+               reacted=CAST(substr(details, instr(details, 'reacted=') + 8) AS INTEGER)
+           WHERE details LIKE 'ack_msg_id=% reacted=%'"""
+    )
+    c.execute("CREATE INDEX IF NOT EXISTS idx_history_sent ON history(sent_at)")
+    # дневные итоги переживают очистку сырых строк
+    c.execute(
+        """CREATE TABLE IF NOT EXISTS history_daily (
+            day TEXT NOT NULL,               -- YYYY-MM-DD (UTC)
+            guild_id INTEGER NOT NULL,
+            reminder_id INTEGER NOT NULL,
+            sends INTEGER NOT NULL,
+            dm_sent INTEGER NOT NULL,
+            dm_failed INTEGER NOT NULL,
+            acks INTEGER NOT NULL,
+            PRIMARY KEY (day, guild_id, reminder_id)
+        ) WITHOUT ROWID"""
+    )
+    c.execute(
+        """INSERT INTO history_daily(day, guild_id, reminder_id, sends, dm_sent, dm_failed, acks)
+           SELECT substr(sent_at, 1, 10), coalesce(guild_id, 0), reminder_id,
+                  count(*), sum(dm_sent), sum(coalesce(dm_failed, 0)), sum(coalesce(reacted, 0))
+           FROM history GROUP BY 1, 2, 3"""
+    )
+
+MIGRATIONS: List[Tuple[int, Callable[[sqlite3.Connection], None]]] = [
+    (1, _migration_1_base),
+    (2, _migration_2_indexes),
+    (3, _migration_3_updated_at),
+    (4, _migration_4_outbox),
+    (5, _migration_5_catchup),
+    (6, _migration_6_history_facts),
+]
+
+def _apply_migrations(conn: sqlite3.Connection) -> int:
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+    for target, migrate in MIGRATIONS:
+        if target <= version:
+            continue
+        conn.execute("BEGIN")
+        try:
+            migrate(conn)
+            conn.execute(f"PRAGMA user_version={target}")
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        version = target
+    return version
+
+def _enable_incremental_vacuum(conn: sqlite3.Connection) -> None:
+    # на непустой БД режим применяется только полным VACUUM, и тот — вне транзакции;
+    # делается один раз, дальше место возвращает incremental_vacuum
+    if conn.execute("PRAGMA auto_vacuum").fetchone()[0] == 2:
+        return
+    conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+    if conn.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+        conn.execute("VACUUM")
+
+def _init_schema(conn: sqlite3.Connection) -> int:
+    _enable_incremental_vacuum(conn)
+    return _apply_migrations(conn)
+
+async def db_init() -> None:
+    """Доводит схему БД до последней версии."""
+    await db.run_write(_init_schema)
+
+async def db_execute(query: str, params: Tuple = ()) -> int:
+    """Выполняет запрос на запись, возвращает lastrowid."""
+    return await db.execute(query, params)
+
+async def db_fetchall(query: str, params: Tuple = ()) -> List[sqlite3.Row]:
+    return await db.fetchall(query, params)
+
+async def db_fetchone(query: str, params: Tuple = ()) -> Optional[sqlite3.Row]:
+    return await db.fetchone(query, params)
+
+async def db_stream(
+    query: str,
+    params: Tuple,
+    cursor: Tuple,
+    next_cursor: Callable[[sqlite3.Row], Tuple],
+    batch: int = REMINDER_LOAD_BATCH,
+) -> AsyncIterator[sqlite3.Row]:
+    """Потоковое чтение по ключу: query получает (*params, *cursor, batch) и должен
+    отдавать строки строго после cursor. В памяти одновременно не больше batch строк."""
+    while True:
+        rows = await db_fetchall(query, params + cursor + (batch,))
+        if not rows:
+            return
+        for r in rows:
+            yield r
+        cursor = next_cursor(rows[-1])
+        await asyncio.sleep(0)
+
+class WriteBehind:
+    """Буфер отложенной записи: копит запросы и коммитит их одной транзакцией
+    раз в WRITE_BEHIND_INTERVAL секунд или как только набралось WRITE_BEHIND_MAX_BATCH.
+    Порядок запросов сохраняется; при ошибке пачка возвращается в начало буфера."""
+
+    def __init__(self, interval: float, max_batch: int) -> None:
+        self.interval = interval
+        self.max_batch = max_batch
+        self._pending: List[Tuple[str, Tuple]] = []
+        self._wakeup = asyncio.Event()
+        self._flush_lock = asyncio.Lock()
+        self._task: Optional[asyncio.Task] = None
+
+    def submit(self, query: str, params: Tuple = ()) -> None:
+        self._pending.append((query, params))
+        if len(self._pending) >= self.max_batch:
+            self._wakeup.set()
+
+    @staticmethod
+    def _apply(batch: List[Tuple[str, Tuple]]) -> Callable[[sqlite3.Connection], None]:
+        def run(conn: sqlite3.Connection) -> None:
+            # подряд идущие одинаковые запросы — одним executemany
+            i = 0
+            while i < len(batch):
+                query = batch[i][0]
+                j = i
+                while j < len(batch) and batch[j][0] == query:
+                    j += 1
+                conn.executemany(query, [params for _, params in batch[i:j]])
+                i = j
+        return run
+
+    async def flush(self) -> None:
+        async with self._flush_lock:
+            while self._pending:
+                batch, self._pending = self._pending, []
+                try:
+                    await db.run_write(self._apply(batch))
+                except Exception:
+                    self._pending[:0] = batch
+                    raise
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                await self.flush()
+            except Exception as e:
+                print(f"⚠️ Ошибка отложенной записи в БД: {e}")
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def close(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+
+write_behind = WriteBehind(WRITE_BEHIND_INTERVAL, WRITE_BEHIND_MAX_BATCH)
+
+class Retention:
+    """Фоновая очистка: раз в RETENTION_INTERVAL удаляет строки history старше
+    HISTORY_RETENTION_DAYS короткими транзакциями по RETENTION_BATCH (писатель не занят надолго),
+    затем возвращает освободившиеся страницы файлу через incremental_vacuum. Дневные итоги
+    в history_daily не трогаются."""
+
+    def __init__(self) -> None:
+        self._task: Optional[asyncio.Task] = None
+
+    @staticmethod
+    def _delete_batch(cutoff: str) -> Callable[[sqlite3.Connection], int]:
+        def run(conn: sqlite3.Connection) -> int:
+            return conn.execute(
+                "DELETE FROM history WHERE id IN (SELECT id FROM history WHERE sent_at < ? LIMIT ?)",
+                (cutoff, RETENTION_BATCH),
+            ).rowcount
+        return run
+
+    @staticmethod
+    def _vacuum_step(conn: sqlite3.Connection) -> int:
+        conn.execute(f"PRAGMA incremental_vacuum({VACUUM_PAGES})").fetchall()
+        return conn.execute("PRAGMA freelist_count").fetchone()[0]
+
+    async def prune(self) -> int:
+        """Один проход очистки; возвращает число удалённых строк."""
+        cutoff = (datetime.utcnow() - timedelta(days=HISTORY_RETENTION_DAYS)).isoformat()
+        deleted = 0
+        while True:
+            n = await db.run_write(self._delete_batch(cutoff))
+            deleted += n
+            if n < RETENTION_BATCH:
+                break
+            await asyncio.sleep(0)
+        while await db.run_write(self._vacuum_step) > 0:
+            await asyncio.sleep(0)
+        return deleted
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                deleted = await self.prune()
+                if deleted:
+                    print(f"🧹 Удалено строк истории: {deleted}")
+            except Exception as e:
+                print(f"⚠️ Ошибка очистки истории: {e}")
+            await asyncio.sleep(RETENTION_INTERVAL)
+
+    def start(self) -> None:
+        if self._task is None and HISTORY_RETENTION_DAYS > 0:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+retention = Retention()
 
 # --------- Утилиты ----------
 DAY_ALIASES = {
@@ -142,299 +739,2016 @@ def prev_day(day: str) -> str:
     idx = DAY_ORDER.index(day)
     return DAY_ORDER[(idx - 1) % 7]
 
-def can_create(ctx: commands.Context) -> bool:
-    if ctx.author == ctx.guild.owner:
-        return True
-    row = db_fetchone(
-        "SELECT 1 FROM allowed_users WHERE guild_id=? AND user_id=?",
-        (ctx.guild.id, ctx.author.id),
-    )
-    return row is not None
+class GuildConfig:
+    """Настройки гильдии, нужные на каждой команде."""
 
-# --------- Планирование ----------
-async def post_ack_and_wait(channel: discord.TextChannel, rid: int, role: Optional[discord.Role], message: str) -> Tuple[List[int], Optional[int]]:
-    """Публикует ACK-сообщение с ✅, ждёт 5 минут, возвращает список user_id с реакцией и id сообщения."""
-    try:
-        mention = role.mention if role else ""
-        ack_msg = await channel.send(f"[ACK {rid}] {mention} {message}\nНажмите ✅, если НЕ хотите получать ЛС по этому напоминанию.")
-        await ack_msg.add_reaction("✅")
-        await asyncio.sleep(300)  # 5 минут
-        # Собираем IDs отреагировавших
-        reacted_ids: List[int] = []
-        for reaction in ack_msg.reactions:
-            if str(reaction.emoji) == "✅":
-                async for u in reaction.users():
-                    if not u.bot:
-                        reacted_ids.append(u.id)
-        return reacted_ids, ack_msg.id
-    except Exception:
-        return [], None
+    __slots__ = ("allowed_users",)
 
-async def do_send(reminder_id: int) -> None:
-    """Основная отправка напоминания (однократная или еженедельная)."""
-    row = db_fetchone("SELECT * FROM reminders WHERE id=? AND active=1", (reminder_id,))
-    if not row:
-        return
+    def __init__(self, allowed_users: Set[int]) -> None:
+        self.allowed_users = allowed_users
 
-    guild = bot.get_guild(row["guild_id"])
-    if not guild:
-        return
+class GuildConfigCache:
+    """LRU-кэш настроек гильдий: грузится из БД при первом обращении, изменения
+    пишутся сквозь кэш, так что проверки прав на диск не ходят."""
 
-    channel = bot.get_channel(CHANNEL_ID)
-    if not isinstance(channel, discord.TextChannel):
-        return
+    def __init__(self, size: int) -> None:
+        self.size = max(1, size)
+        self._entries: "OrderedDict[int, GuildConfig]" = OrderedDict()
+        self._writes: Dict[int, int] = {}  # guild_id -> счётчик записей, чтобы не закэшировать устаревшую загрузку
 
-    kind = row["kind"]           # 'role' | 'dm'
-    role_id = row["role_id"]
-    target_user_id = row["target_user_id"]
-    message = row["message"]
-    ack_required = bool(row["ack_required"])
+    async def get(self, guild_id: int) -> GuildConfig:
+        config = self._entries.get(guild_id)
+        if config is not None:
+            self._entries.move_to_end(guild_id)
+            return config
+        while True:
+            seen = self._writes.get(guild_id, 0)
+            rows = await db_fetchall("SELECT user_id FROM allowed_users WHERE guild_id=?", (guild_id,))
+            if self._writes.get(guild_id, 0) == seen:
+                break
+        config = self._entries.get(guild_id)
+        if config is None:
+            config = self._entries[guild_id] = GuildConfig({r["user_id"] for r in rows})
+            if len(self._entries) > self.size:
+                evicted, _ = self._entries.popitem(last=False)
+                self._writes.pop(evicted, None)
+        return config
 
-    role: Optional[discord.Role] = guild.get_role(role_id) if role_id else None
+    async def allow(self, guild_id: int, user_id: int) -> None:
+        await db_execute("INSERT OR IGNORE INTO allowed_users(guild_id, user_id) VALUES (?,?)", (guild_id, user_id))
+        self._writes[guild_id] = self._writes.get(guild_id, 0) + 1
+        config = self._entries.get(guild_id)
+        if config is not None:
+            config.allowed_users.add(user_id)
 
-    reacted_ids: List[int] = []
-    ack_message_id: Optional[int] = None
+    async def disallow(self, guild_id: int, user_id: int) -> None:
+        await db_execute("DELETE FROM allowed_users WHERE guild_id=? AND user_id=?", (guild_id, user_id))
+        self._writes[guild_id] = self._writes.get(guild_id, 0) + 1
+        config = self._entries.get(guild_id)
+        if config is not None:
+            config.allowed_users.discard(user_id)
 
-    # Если включена проверка реакции — постим ACK заранее в том же джобе, ждём 5 минут.
-    if ack_required:
-        reacted_ids, ack_message_id = await post_ack_and_wait(channel, row["id"], role if kind == "role" else None, message)
+guild_configs = GuildConfigCache(GUILD_CACHE_SIZE)
 
-    dm_sent = 0
+async def can_create(ctx: commands.Context) -> bool:
+    if ctx.author.id == ctx.guild.owner_id:
+        return True
+    config = await guild_configs.get(ctx.guild.id)
+    return ctx.author.id in config.allowed_users
 
-    if kind == "role":
-        # Публикуем основное сообщение в канал (с тегом роли)
-        if role is not None:
-            await channel.send(f"{role.mention} {message}")
-        else:
-            await channel.send(message)
+# --------- Рассылка ЛС ----------
+class TokenBucket:
+    """Token bucket для asyncio: не больше rate запросов в секунду с запасом burst. rate можно менять на лету."""
 
-        # Рассылаем ЛС тем, кто НЕ поставил ✅ (и кто видит канал)
-        if role is not None:
-            for member in role.members:
-                if member.bot:
-                    continue
-                perms = channel.permissions_for(member)
-                sees_channel = perms.read_messages
-                if ack_required and sees_channel and member.id in reacted_ids:
-                    continue
-                try:
-                    await member.send(message)
-                    dm_sent += 1
-                except Exception:
-                    # игнорируем закрытые ЛС
-                    pass
-    else:
-        # kind == 'dm' — одно целевое лицо
-        if not target_user_id:
-            return
-        member = guild.get_member(target_user_id)
-        if member and not member.bot:
-            # Если ack включён, проверяем реакцию пользователя (если у него есть доступ к каналу)
-            if ack_required:
-                perms = channel.permissions_for(member)
-                if perms.read_messages and member.id in reacted_ids:
-                    pass  # пропускаем ЛС
-                else:
-                    try:
-                        await member.send(message)
-                        dm_sent += 1
-                    except Exception:
-                        pass
-            else:
-                try:
-                    await member.send(message)
-                    dm_sent += 1
-                except Exception:
-                    pass
+    def __init__(self, rate: float, burst: Optional[float] = None) -> None:
+        self.rate = rate
+        self.burst = burst if burst is not None else rate
+        self._tokens = self.burst
+        self._updated = time.monotonic()
 
-    # История
-    db_execute(
-        "INSERT INTO history(reminder_id, sent_at, dm_sent, details) VALUES (?,?,?,?)",
-        (row["id"], datetime.utcnow().isoformat(), dm_sent, f"ack_msg_id={ack_message_id} reacted={len(reacted_ids)}"),
-    )
+    async def acquire(self, cost: float = 1.0) -> None:
+        while True:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            if self._tokens >= cost:
+                self._tokens -= cost
+                return
+            await asyncio.sleep((cost - self._tokens) / self.rate)
 
-    # Если одноразовое — деактивируем
-    if row["mode"] == "one":
-        db_execute("UPDATE reminders SET active=0 WHERE id=?", (row["id"],))
+class DMFanout:
+    """Конкурентная рассылка ЛС. Бюджет запросов общий для всех напоминаний: глобальный лимит
+    и маршрут открытия ЛС-каналов; на 429 все воркеры встают на паузу, а темп падает вдвое
+    и потом плавно возвращается (AIMD)."""
 
-def schedule_reminder(row: sqlite3.Row) -> None:
-    """Ставит задачи в APScheduler в зависимости от режима и ack."""
-    rid = row["id"]
-    mode = row["mode"]
-    ack_required = bool(row["ack_required"])
+    def __init__(self, concurrency: int, global_rate: float, open_rate: float) -> None:
+        self.concurrency = max(1, concurrency)
+        self.max_rate = global_rate
+        self.global_bucket = TokenBucket(global_rate)
+        self.open_bucket = TokenBucket(open_rate)
+        self._slots = asyncio.Semaphore(self.concurrency)
+        self._paused_until = 0.0
+        self._dm_channels: Dict[int, int] = {}  # user_id -> id ЛС-канала
+        self._ratelimit_hits = metrics.counter("bot_dm_ratelimit_total")
 
-    if mode == "one":
-        # Если ack включён — запускаем джоб за 5 мин до времени (внутри он подождёт 5 мин и отправит)
-        run_at = dateparser.parse(row["run_at"])
-        if ack_required:
-            run_at = run_at - timedelta(minutes=5)
-        scheduler.add_job(do_send, DateTrigger(run_date=run_at), args=[rid], id=f"rem_{rid}", replace_existing=True)
-    else:
-        # weekly: считаем время старта джоба (если ack — минус 5 минут + сдвиг дня)
-        days = [d.strip() for d in row["weekly_days"].split(",") if d.strip()]
-        days = [d for d in days if d in DAY_ORDER]
-        hh, mm = parse_hhmm(row["weekly_time"])
-        if ack_required:
-            # вычисляем смещение
-            day_shift, nh, nm = adjust_time_minus_minutes(hh, mm, 5)
-            if day_shift == 0:
-                cron_days = days
-            else:
-                # сдвиг на предыдущий день
-                cron_days = [prev_day(d) for d in days]
-            scheduler.add_job(
-                do_send,
-                CronTrigger(day_of_week=",".join(cron_days), hour=nh, minute=nm),
-                args=[rid],
-                id=f"rem_{rid}",
-                replace_existing=True,
-            )
-        else:
-            scheduler.add_job(
-                do_send,
-                CronTrigger(day_of_week=",".join(days), hour=hh, minute=mm),
-                args=[rid],
-                id=f"rem_{rid}",
-                replace_existing=True,
-            )
+    def _on_ratelimit(self, retry_after: float) -> None:
+        self._ratelimit_hits.inc()
+        self._paused_until = max(self._paused_until, time.monotonic() + retry_after)
+        self.global_bucket.rate = max(1.0, self.global_bucket.rate / 2)
 
-async def load_all_reminders() -> None:
-    rows = db_fetchall("SELECT * FROM reminders WHERE active=1")
-    for r in rows:
-        schedule_reminder(r)
+    def _on_success(self) -> None:
+        if self.global_bucket.rate < self.max_rate:
+            self.global_bucket.rate = min(self.max_rate, self.global_bucket.rate + self.max_rate / 100)
 
-# --------- Команды ----------
-@bot.event
-async def on_ready():
-    db_init()
-    if CHANNEL_ID == 0:
-        print("⚠️ Переменная окружения CHANNEL_ID не задана!")
-    scheduler.start()
-    await load_all_reminders()
-    print(f"✅ Бот запущен как {bot.user} (готов)")
+    async def _open_channel(self, user_id: int) -> discord.PartialMessageable:
+        channel_id = self._dm_channels.get(user_id)
+        if channel_id is None:
+            await self.open_bucket.acquire()
+            await self.global_bucket.acquire()
+            data = await bot.http.start_private_message(user_id)
+            channel_id = int(data["id"])
+            self._dm_channels[user_id] = channel_id
+        return bot.get_partial_messageable(channel_id, type=discord.ChannelType.private)
 
-def ensure_allowed():
-    async def predicate(ctx: commands.Context):
-        if not ctx.guild:
-            await ctx.send("Эту команду можно использовать только на сервере.")
-            return False
-        if can_create(ctx):
-            return True
-        await ctx.send("⛔ У вас нет прав для этой команды.")
-        return False
-    return commands.check(predicate)
+    async def send_dm(self, user_id: int, content: str) -> str:
+        """Одно ЛС: 'sent' | 'forbidden' | 'failed' | 'rate_limited' (повторы после 429 исчерпаны)."""
+        status = await self._send_dm(user_id, content)
+        metrics.counter("bot_dm_total", status=status).inc()
+        return status
 
-@bot.command(name="add_allowed_user")
-async def add_allowed_user_cmd(ctx: commands.Context, user_id: int):
-    if ctx.author != ctx.guild.owner:
-        await ctx.send("⛔ Только владелец сервера может добавлять разрешённых.")
-        return
-    db_execute("INSERT OR IGNORE INTO allowed_users(guild_id, user_id) VALUES (?,?)", (ctx.guild.id, user_id))
-    await ctx.send(f"✅ Пользователь `{user_id}` добавлен в белый список.")
+    async def _send_dm(self, user_id: int, content: str) -> str:
+        for _ in range(DM_MAX_RETRIES + 1):
+            delay = self._paused_until - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            async with self._slots:
+                try:
+                    channel = await self._open_channel(user_id)
+                    await self.global_bucket.acquire()
+                    await channel.send(content)
+                    self._on_success()
+                    return "sent"
+                except discord.Forbidden:
+                    # закрытые ЛС
+                    return "forbidden"
+                except discord.RateLimited as e:
+                    retry_after = e.retry_after
+                except discord.HTTPException as e:
+                    if e.status != 429:
+                        return "failed"
+                    retry_after = float(e.response.headers.get("Retry-After", 1))
+                except Exception:
+                    return "failed"
+            self._on_ratelimit(retry_after)
+        return "rate_limited"
 
-@bot.command(name="remove_allowed_user")
-async def remove_allowed_user_cmd(ctx: commands.Context, user_id: int):
-    if ctx.author != ctx.guild.owner:
-        await ctx.send("⛔ Только владелец сервера может убирать разрешённых.")
-        return
-    db_execute("DELETE FROM allowed_users WHERE guild_id=? AND user_id=?", (ctx.guild.id, user_id))
-    await ctx.send(f"✅ Пользователь `{user_id}` удалён из белого списка.")
+dm_fanout = DMFanout(DM_CONCURRENCY, DM_GLOBAL_RATE, DM_OPEN_RATE)
 
-@bot.command(name="list_reminders")
-@ensure_allowed()
-async def list_reminders_cmd(ctx: commands.Context):
-    rows = db_fetchall("SELECT * FROM reminders WHERE guild_id=? AND active=1 ORDER BY id DESC LIMIT 20", (ctx.guild.id,))
-    if not rows:
-        await ctx.send("📭 Активных напоминаний нет.")
-        return
-    lines = []
-    for r in rows:
-        if r["mode"] == "one":
-            when = r["run_at"]
-        else:
-            when = f"{r['weekly_days']} @ {r['weekly_time']}"
-        target = f"role:{r['role_id']}" if r["kind"] == "role" else f"user:{r['target_user_id']}"
-        lines.append(f"ID {r['id']} | {target} | {r['mode']} | {when} | ack={r['ack_required']}")
-    await ctx.send("**Напоминания:**\n" + "\n".join(lines))
+class DeliveryReport:
+    """Итог отправки одного напоминания: число получателей, доставленных и недоставленных ЛС
+    и статус каждого недоставленного ('forbidden' | 'failed' | 'rate_limited') по user_id."""
 
-@bot.command(name="history")
-@ensure_allowed()
-async def history_cmd(ctx: commands.Context):
-    rows = db_fetchall(
-        """SELECT h.reminder_id, h.sent_at, h.dm_sent
-           FROM history h
-           JOIN reminders r ON r.id=h.reminder_id
-           WHERE r.guild_id=?
-           ORDER BY h.sent_at DESC LIMIT 20""",
-        (ctx.guild.id,),
-    )
-    if not rows:
-        await ctx.send("📜 История пуста.")
-        return
-    text = "\n".join([f"RID {r['reminder_id']} — {r['sent_at']} — DM: {r['dm_sent']}" for r in rows])
-    await ctx.send("**История отправок (последние 20):**\n" + text)
+    __slots__ = ("reminder_id", "recipients", "dm_sent", "dm_failed", "failures")
 
-# --------- Мастер создания напоминания ---------
-@bot.command(name="reminder")
-@ensure_allowed()
-async def reminder_cmd(ctx: commands.Context):
-    await ctx.send("Какой тип напоминания? Введите `role` или `dm`.")
+    def __init__(self, reminder_id: int, recipients: int, dm_sent: int, dm_failed: int, failures: Dict[int, str]) -> None:
+        self.reminder_id = reminder_id
+        self.recipients = recipients
+        self.dm_sent = dm_sent
+        self.dm_failed = dm_failed
+        self.failures = failures
 
-    def author_check(m: discord.Message) -> bool:
-        return m.author == ctx.author and m.channel == ctx.channel
+class _OutboxBatch:
+    __slots__ = ("key", "payload", "remaining", "dm_sent", "dm_failed", "recipients", "failures", "done", "total")
 
-    try:
-        msg_kind = await bot.wait_for("message", timeout=120.0, check=author_check)
-    except asyncio.TimeoutError:
-        await ctx.send("⏰ Время ожидания истекло.")
-        return
+    def __init__(self, key: str, payload: List[dict]) -> None:
+        self.key = key
+        self.payload = payload
+        self.remaining = 0
+        self.total = 0
+        self.dm_sent: Dict[int, int] = {p["reminder_id"]: 0 for p in payload}
+        self.dm_failed: Dict[int, int] = dict(self.dm_sent)
+        self.recipients: Dict[int, int] = dict(self.dm_sent)
+        self.failures: Dict[int, Dict[int, str]] = {rid: {} for rid in self.dm_sent}
+        self.done: asyncio.Future = asyncio.get_running_loop().create_future()
 
-    kind = msg_kind.content.strip().lower()
-    if kind not in ("role", "dm"):
-        await ctx.send("Нужно ввести `role` или `dm`.")
-        return
+    def record(self, user_id: int, status: str, rids: Tuple[int, ...]) -> None:
+        """Итоговый статус получателя по каждому напоминанию, которое ему ушло."""
+        for rid in rids:
+            if status == "sent":
+                self.dm_sent[rid] = self.dm_sent.get(rid, 0) + 1
+            else:
+                self.dm_failed[rid] = self.dm_failed.get(rid, 0) + 1
+                self.failures.setdefault(rid, {})[user_id] = status
 
-    role_id = None
-    target_user_id = None
+    def reports(self) -> Dict[int, DeliveryReport]:
+        return {
+            rid: DeliveryReport(rid, self.recipients.get(rid, 0), self.dm_sent.get(rid, 0),
+                                self.dm_failed.get(rid, 0), self.failures.get(rid, {}))
+            for rid in (p["reminder_id"] for p in self.payload)
+        }
 
-    if kind == "role":
-        roles = [r for r in ctx.guild.roles if r != ctx.guild.default_role]
-        if not roles:
-            await ctx.send("На сервере нет ролей, кроме @everyone.")
-            return
+class Outbox:
+    """Долговечная очередь ЛС: до первой отправки все получатели пачки записываются в outbox
+    одной транзакцией, затем их разбирают OUTBOX_WORKERS воркеров через dm_fanout. Итоговый
+    статус получателя коммитится до того, как воркер возьмёт следующего (статусы всех воркеров
+    уходят одной групповой транзакцией); после сбоя start() поднимает незавершённые пачки и
+    продолжает с того места, где остановились. Повторно может уйти только ЛС, отправленное, но
+    ещё не закоммиченное в момент сбоя, — не больше OUTBOX_WORKERS штук: у Discord нет ключа
+    идемпотентности, так что доставка «хотя бы раз». Повторы — с экспоненциальной паузой."""
 
-        options = [discord.SelectOption(label=r.name[:100], value=str(r.id)) for r in roles[:25]]  # Discord ограничение 25
-        select = Select(placeholder="Выберите роль для напоминания", min_values=1, max_values=1, options=options)
+    def __init__(self) -> None:
+        self._batches: Dict[str, _OutboxBatch] = {}
+        self._queue: "asyncio.Queue[Tuple[int, str, int, str, Tuple[int, ...], int]]" = asyncio.Queue()
+        self._workers: List[asyncio.Task] = []
 
-        async def on_select(interaction: discord.Interaction):
-            nonlocal role_id
-            if interaction.user != ctx.author:
-                await interaction.response.send_message("Только инициатор может выбирать.", ephemeral=True)
-                return
-            role_id = int(select.values[0])
-            await interaction.response.edit_message(content=f"Выбрана роль: <@&{role_id}>", view=None)
+    async def start(self) -> None:
+        for b in await db_fetchall("SELECT batch_key, payload FROM delivery_batches"):
+            rows = await db_fetchall(self._ROWS_QUERY, (b["batch_key"],))
+            batch = self._load_batch(b["batch_key"], json.loads(b["payload"]), rows)
+            if batch.remaining == 0:
+                self._finalize(batch)
+        self._workers = [asyncio.create_task(self._worker()) for _ in range(max(1, OUTBOX_WORKERS))]
 
-        view = View(timeout=120)
-        select.callback = on_select
-        view.add_item(select)
-        await ctx.send("Выберите роль:", view=view)
+    async def stop(self) -> None:
+        for task in self._workers:
+            task.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
 
-        # ждём, пока пользователь нажмёт
-        def role_chosen() -> bool:
-            return role_id is not None
+    _ROWS_QUERY = "SELECT id, user_id, reminder_ids, content, status, attempts FROM outbox WHERE batch_key=?"
 
-        for _ in range(120):
-            if role_chosen():
-                break
-            await asyncio.sleep(1)
+    def _load_batch(self, key: str, payload: List[dict], rows: List[sqlite3.Row]) -> _OutboxBatch:
+        batch = self._batches.get(key)
+        if batch is not None:
+            return batch
+        batch = self._batches[key] = _OutboxBatch(key, payload)
+        batch.total = len(rows)
+        for r in rows:
+            rids = tuple(int(x) for x in r["reminder_ids"].split(","))
+            self._count(batch.recipients, rids)
+            if r["status"] == "pending":
+                batch.remaining += 1
+                self._queue.put_nowait((r["id"], key, r["user_id"], r["content"], rids, r["attempts"]))
+            else:
+                batch.record(r["user_id"], r["status"], rids)
+        return batch
+
+    @staticmethod
+    def _count(counter: Dict[int, int], rids: Tuple[int, ...]) -> None:
+        for rid in rids:
+            counter[rid] = counter.get(rid, 0) + 1
 
-        if role_id is None:
+    def pending(self) -> int:
+        """Сколько ЛС ещё ждут отправки."""
+        return sum(b.remaining for b in self._batches.values())
+
+    async def enqueue(
+        self,
+        key: str,
+        payload: List[dict],
+        items: Sequence[Tuple[int, str, Tuple[int, ...]]],
+        writes: Sequence[Tuple[str, Tuple]] = (),
+    ) -> asyncio.Future:
+        """Атомарно сохраняет пачку (user_id, текст, reminder_ids) и сопутствующие изменения
+        состояния, ставит получателей в очередь. Возвращает future завершения пачки — с отчётом
+        {reminder_id: DeliveryReport} по каждому напоминанию пачки."""
+        def run(conn: sqlite3.Connection) -> List[sqlite3.Row]:
+            conn.execute(
+                "INSERT OR IGNORE INTO delivery_batches(batch_key, payload, created_at) VALUES (?,?,?)",
+                (key, json.dumps(payload), datetime.utcnow().isoformat()),
+            )
+            conn.executemany(
+                "INSERT OR IGNORE INTO outbox(batch_key, user_id, reminder_ids, content) VALUES (?,?,?,?)",
+                ((key, uid, ",".join(map(str, rids)), content) for uid, content, rids in items),
+            )
+            for query, params in writes:
+                conn.execute(query, params)
+            return conn.execute(self._ROWS_QUERY, (key,)).fetchall()
+
+        batch = self._load_batch(key, payload, await db.run_write(run))
+        if batch.remaining == 0:
+            self._finalize(batch)
+        return batch.done
+
+    def _finalize(self, batch: _OutboxBatch) -> None:
+        # История по каждому напоминанию пачки; сама пачка больше не нужна
+        if self._batches.pop(batch.key, None) is None:
+            return
+        sent_at = datetime.utcnow().isoformat()
+        facts = [
+            (p["reminder_id"], p["guild_id"], batch.dm_sent.get(p["reminder_id"], 0),
+             batch.dm_failed.get(p["reminder_id"], 0), p["reacted"])
+            for p in batch.payload
+        ]
+        # сначала все строки history, потом все итоги — write_behind склеит их в два executemany
+        for (rid, guild_id, sent, failed, reacted), p in zip(facts, batch.payload):
+            write_behind.submit(
+                """INSERT INTO history(reminder_id, guild_id, sent_at, dm_sent, dm_failed, recipients, ack_message_id, reacted)
+                   VALUES (?,?,?,?,?,?,?,?)""",
+                (rid, guild_id, sent_at, sent, failed, batch.recipients.get(rid, 0), p["ack_message_id"], reacted),
+            )
+        for rid, guild_id, sent, failed, reacted in facts:
+            write_behind.submit(
+                """INSERT INTO history_daily(day, guild_id, reminder_id, sends, dm_sent, dm_failed, acks)
+                   VALUES (?,?,?,1,?,?,?)
+                   ON CONFLICT(day, guild_id, reminder_id) DO UPDATE SET
+                       sends=sends+1, dm_sent=dm_sent+excluded.dm_sent,
+                       dm_failed=dm_failed+excluded.dm_failed, acks=acks+excluded.acks""",
+                (sent_at[:10], guild_id, rid, sent, failed, reacted),
+            )
+        write_behind.submit("DELETE FROM outbox WHERE batch_key=?", (batch.key,))
+        write_behind.submit("DELETE FROM delivery_batches WHERE batch_key=?", (batch.key,))
+        if not batch.done.done():
+            batch.done.set_result(batch.reports())
+
+    async def _worker(self) -> None:
+        while True:
+            row_id, key, uid, content, rids, attempts = await self._queue.get()
+            batch = self._batches.get(key)
+            if batch is None:
+                continue
+            status = await dm_fanout.send_dm(uid, content)
+            attempts += 1
+            if status in ("rate_limited", "failed") and attempts < OUTBOX_MAX_ATTEMPTS:
+                write_behind.submit("UPDATE outbox SET attempts=? WHERE id=?", (attempts, row_id))
+                delay = OUTBOX_BACKOFF * 2 ** (attempts - 1)
+                asyncio.get_running_loop().call_later(
+                    delay, self._queue.put_nowait, (row_id, key, uid, content, rids, attempts)
+                )
+                continue
+            write_behind.submit("UPDATE outbox SET status=?, attempts=? WHERE id=?", (status, attempts, row_id))
+            try:
+                # групповой коммит: flush под замком забирает статусы всех воркеров сразу
+                await write_behind.flush()
+            except Exception as e:
+                print(f"⚠️ Не удалось записать статус ЛС (повтор при следующем сбросе): {e}")
+            batch.record(uid, status, rids)
+            batch.remaining -= 1
+            done = batch.total - batch.remaining
+            if done % DM_PROGRESS_EVERY == 0 or batch.remaining == 0:
+                print(f"[{key}] ЛС: {done}/{batch.total}")
+            if batch.remaining == 0:
+                self._finalize(batch)
+
+outbox = Outbox()
+metrics.gauge("bot_outbox_pending", outbox.pending)
+
+# --------- Индекс ACK-реакций ----------
+class AckIndex:
+    """ACK-сообщение -> множество user_id, поставивших ✅. Наполняется событиями реакций
+    через gateway и дублируется в SQLite, чтобы пережить перезапуск."""
+
+    def __init__(self) -> None:
+        self._reacted: Dict[int, Set[int]] = {}
+
+    async def load(self) -> None:
+        self._reacted = {r["message_id"]: set() for r in await db_fetchall("SELECT message_id FROM ack_messages")}
+        for r in await db_fetchall("SELECT message_id, user_id FROM ack_reactions"):
+            self._reacted.setdefault(r["message_id"], set()).add(r["user_id"])
+
+    def tracks(self, message_id: int) -> bool:
+        return message_id in self._reacted
+
+    def reacted(self, message_id: Optional[int]) -> Set[int]:
+        if message_id is None:
+            return set()
+        return self._reacted.get(message_id, set())
+
+    async def register(self, message_id: int, reminder_id: int) -> None:
+        self._reacted.setdefault(message_id, set())
+        await db_execute(
+            "INSERT OR IGNORE INTO ack_messages(message_id, reminder_id, created_at) VALUES (?,?,?)",
+            (message_id, reminder_id, datetime.utcnow().isoformat()),
+        )
+
+    def add(self, message_id: int, user_id: int) -> None:
+        users = self._reacted.get(message_id)
+        if users is None or user_id in users:
+            return
+        users.add(user_id)
+        write_behind.submit("INSERT OR IGNORE INTO ack_reactions(message_id, user_id) VALUES (?,?)", (message_id, user_id))
+
+    def remove(self, message_id: int, user_id: int) -> None:
+        users = self._reacted.get(message_id)
+        if users is None or user_id not in users:
+            return
+        users.discard(user_id)
+        write_behind.submit("DELETE FROM ack_reactions WHERE message_id=? AND user_id=?", (message_id, user_id))
+
+    def forget(self, message_id: int) -> None:
+        """Доставка по ACK-сообщению завершена — реакции больше не нужны."""
+        self._reacted.pop(message_id, None)
+        write_behind.submit("DELETE FROM ack_reactions WHERE message_id=?", (message_id,))
+        write_behind.submit("DELETE FROM ack_messages WHERE message_id=?", (message_id,))
+
+ack_index = AckIndex()
+
+@bot.event
+async def on_raw_reaction_add(payload: discord.RawReactionActionEvent):
+    if not ack_index.tracks(payload.message_id) or str(payload.emoji) != ACK_EMOJI:
+        return
+    if payload.user_id == bot.user.id or (payload.member is not None and payload.member.bot):
+        return
+    ack_index.add(payload.message_id, payload.user_id)
+
+@bot.event
+async def on_raw_reaction_remove(payload: discord.RawReactionActionEvent):
+    if ack_index.tracks(payload.message_id) and str(payload.emoji) == ACK_EMOJI:
+        ack_index.remove(payload.message_id, payload.user_id)
+
+# --------- Индекс участников ----------
+class MemberIndex:
+    """Компактный индекс участников вместо полного кэша discord.py. Хранит только роли и
+    пользователей из активных напоминаний: role_id -> array('Q') user_id, user_id -> общий
+    (интернированный) кортеж его ролей и множество ботов. Наполняется чанками участников
+    и событиями GUILD_MEMBER_* прямо из gateway. Цели считаются по ссылкам из напоминаний:
+    когда последнее напоминание роли/пользователя снято, цель уходит из индекса."""
+
+    def __init__(self) -> None:
+        self._tracked_roles: Dict[int, Set[int]] = {}  # guild_id -> role_id
+        self._tracked_users: Dict[int, Set[int]] = {}  # guild_id -> user_id
+        self._targets: Dict[int, Tuple[int, str, int]] = {}  # reminder_id -> (guild_id, kind, цель)
+        self._refs: Dict[Tuple[int, str, int], int] = {}     # цель -> число напоминаний
+        self._role_members: Dict[int, array] = {}      # role_id -> user_id
+        self._member_roles: Dict[int, Dict[int, Tuple[int, ...]]] = {}  # guild_id -> user_id -> роли
+        self._role_sets: Dict[Tuple[int, ...], Tuple[int, ...]] = {}
+        self._bots: Set[int] = set()
+        self._ready: Dict[int, asyncio.Event] = {}
+        self._rechunk: Set[int] = set()
+
+    def install(self, state) -> None:
+        """Подключается к парсерам gateway: сначала индекс, затем штатная обработка discord.py."""
+        handlers = {
+            "GUILD_MEMBERS_CHUNK": self._on_chunk,
+            "GUILD_MEMBER_ADD": self._on_member,
+            "GUILD_MEMBER_UPDATE": self._on_member,
+            "GUILD_MEMBER_REMOVE": self._on_member_remove,
+            "GUILD_ROLE_DELETE": self._on_role_delete,
+        }
+        for event, handler in handlers.items():
+            original = state.parsers[event]
+
+            def parser(data, original=original, handler=handler):
+                try:
+                    handler(data)
+                except Exception as e:
+                    print(f"⚠️ Индекс участников: ошибка обработки события: {e}")
+                original(data)
+
+            state.parsers[event] = parser
+
+    def track(self, row: sqlite3.Row) -> None:
+        """Добавляет роль/пользователя напоминания в индекс (повторный вызов ничего не меняет)."""
+        gid = row["guild_id"]
+        if row["kind"] == "role" and row["role_id"]:
+            key = (gid, "role", row["role_id"])
+        elif row["kind"] == "dm" and row["target_user_id"]:
+            key = (gid, "dm", row["target_user_id"])
+        else:
+            self.untrack(row["id"])
+            return
+        if self._targets.get(row["id"]) == key:
+            return
+        self.untrack(row["id"])
+        self._targets[row["id"]] = key
+        self._refs[key] = self._refs.get(key, 0) + 1
+        targets = (self._tracked_roles if key[1] == "role" else self._tracked_users).setdefault(gid, set())
+        target = key[2]
+        if target in targets:
+            return
+        targets.add(target)
+        if gid in self._ready and gid not in self._rechunk:
+            # индекс гильдии уже построен — для новой цели нужен повторный запрос участников
+            self._rechunk.add(gid)
+            asyncio.get_running_loop().call_later(1.0, lambda: asyncio.ensure_future(self.request(gid)))
+
+    def untrack(self, reminder_id: int) -> None:
+        """Напоминание деактивировано или снято: цель без других напоминаний уходит из индекса."""
+        key = self._targets.pop(reminder_id, None)
+        if key is None:
+            return
+        refs = self._refs.pop(key) - 1
+        if refs > 0:
+            self._refs[key] = refs
+            return
+        gid, kind, target = key
+        members = self._member_roles.get(gid, {})
+        if kind == "role":
+            self._tracked_roles.get(gid, set()).discard(target)
+            candidates = self._role_members.pop(target, array("Q"))
+        else:
+            self._tracked_users.get(gid, set()).discard(target)
+            candidates = (target,)
+        roles = self._tracked_roles.get(gid, set())
+        users = self._tracked_users.get(gid, set())
+        for uid in candidates:
+            if uid not in users and not roles.intersection(members.get(uid, ())):
+                members.pop(uid, None)
+
+    async def request(self, guild_id: int) -> None:
+        """(Пере)строит индекс гильдии по чанкам участников из gateway."""
+        self._rechunk.discard(guild_id)
+        roles = self._tracked_roles.get(guild_id, set())
+        if not roles and not self._tracked_users.get(guild_id):
+            return
+        self._member_roles[guild_id] = {}
+        for rid in roles:
+            self._role_members[rid] = array("Q")
+        event = self._ready.setdefault(guild_id, asyncio.Event())
+        event.clear()
+        await bot._connection.chunker(guild_id)
+
+    async def wait_ready(self, guild_id: int) -> None:
+        if guild_id not in self._ready:
+            await self.request(guild_id)
+        event = self._ready.get(guild_id)
+        if event is None:
+            return
+        try:
+            await asyncio.wait_for(event.wait(), timeout=MEMBER_INDEX_WAIT)
+        except asyncio.TimeoutError:
+            print(f"⚠️ Индекс участников гильдии {guild_id} не достроен, отправка по неполным данным.")
+
+    def indexed(self, guild_id: int) -> bool:
+        """Индекс гильдии достроен (все чанки получены)."""
+        event = self._ready.get(guild_id)
+        return event is not None and event.is_set()
+
+    def role_members(self, role_id: int) -> array:
+        return self._role_members.get(role_id, array("Q"))
+
+    def member_roles(self, guild_id: int, user_id: int) -> Optional[Tuple[int, ...]]:
+        """Роли участника или None, если он не в гильдии (или не попал в индекс)."""
+        return self._member_roles.get(guild_id, {}).get(user_id)
+
+    def is_bot(self, user_id: int) -> bool:
+        return user_id in self._bots
+
+    def _upsert(self, guild_id: int, data: dict) -> None:
+        roles = self._tracked_roles.get(guild_id, set())
+        users = self._tracked_users.get(guild_id, set())
+        if not roles and not users:
+            return
+        uid = int(data["user"]["id"])
+        role_ids = tuple(sorted(int(r) for r in data.get("roles", ())))
+        members = self._member_roles.setdefault(guild_id, {})
+        old = members.get(uid, ())
+        new_tracked = roles.intersection(role_ids)
+        for rid in new_tracked.difference(old):
+            self._role_members.setdefault(rid, array("Q")).append(uid)
+        for rid in roles.intersection(old).difference(new_tracked):
+            self._drop(rid, uid)
+        if new_tracked or uid in users:
+            members[uid] = self._role_sets.setdefault(role_ids, role_ids)
+            if data["user"].get("bot"):
+                self._bots.add(uid)
+        else:
+            members.pop(uid, None)
+
+    def _drop(self, role_id: int, user_id: int) -> None:
+        try:
+            self._role_members[role_id].remove(user_id)
+        except (KeyError, ValueError):
+            pass
+
+    def _on_chunk(self, data: dict) -> None:
+        gid = int(data["guild_id"])
+        for member in data.get("members", ()):
+            self._upsert(gid, member)
+        if data.get("chunk_index", 0) + 1 >= data.get("chunk_count", 1):
+            event = self._ready.get(gid)
+            if event is not None:
+                event.set()
+
+    def _on_member(self, data: dict) -> None:
+        self._upsert(int(data["guild_id"]), data)
+
+    def _on_member_remove(self, data: dict) -> None:
+        gid = int(data["guild_id"])
+        uid = int(data["user"]["id"])
+        old = self._member_roles.get(gid, {}).pop(uid, ())
+        for rid in self._tracked_roles.get(gid, set()).intersection(old):
+            self._drop(rid, uid)
+
+    def _on_role_delete(self, data: dict) -> None:
+        rid = int(data["role_id"])
+        self._tracked_roles.get(int(data["guild_id"]), set()).discard(rid)
+        self._role_members.pop(rid, None)
+
+member_index = MemberIndex()
+
+VIEW_CHANNEL = discord.Permissions(view_channel=True).value
+ADMINISTRATOR = discord.Permissions(administrator=True).value
+
+def channel_overwrites(channel: discord.abc.GuildChannel) -> Dict[int, Tuple[int, int]]:
+    """target_id -> (allow, deny) в виде битовых масок."""
+    result: Dict[int, Tuple[int, int]] = {}
+    for target, overwrite in channel.overwrites.items():
+        allow, deny = overwrite.pair()
+        result[target.id] = (allow.value, deny.value)
+    return result
+
+def sees_channel(guild: discord.Guild, overwrites: Dict[int, Tuple[int, int]], user_id: int, role_ids: Tuple[int, ...]) -> bool:
+    """Право view_channel по ролям участника — та же логика, что в permissions_for, но без объекта Member."""
+    if user_id == guild.owner_id:
+        return True
+    perms = guild.default_role.permissions.value
+    for rid in role_ids:
+        role = guild.get_role(rid)
+        if role is not None:
+            perms |= role.permissions.value
+    if perms & ADMINISTRATOR:
+        return True
+    allow, deny = overwrites.get(guild.id, (0, 0))  # @everyone
+    perms = (perms & ~deny) | allow
+    role_allow = role_deny = 0
+    for rid in role_ids:
+        a, d = overwrites.get(rid, (0, 0))
+        role_allow |= a
+        role_deny |= d
+    perms = (perms & ~role_deny) | role_allow
+    allow, deny = overwrites.get(user_id, (0, 0))
+    perms = (perms & ~deny) | allow
+    return bool(perms & VIEW_CHANNEL)
+
+class VisibilityCache:
+    """Кэш права view_channel: канал -> набор ролей участника -> bool. Набор ролей берётся из
+    MemberIndex (интернированный кортеж), поэтому смена ролей участника сама даёт новый ключ;
+    изменения каналов, ролей и гильдии сбрасывают кэш событиями. Участников с личным
+    overwrite и владельца не кэшируем."""
+
+    def __init__(self) -> None:
+        self._overwrites: Dict[int, Dict[int, Tuple[int, int]]] = {}  # channel_id -> overwrites
+        self._visible: Dict[int, Dict[Tuple[int, ...], bool]] = {}     # channel_id -> роли -> видит
+
+    def sees(self, channel: discord.abc.GuildChannel, user_id: int, role_ids: Tuple[int, ...]) -> bool:
+        overwrites = self._overwrites.get(channel.id)
+        if overwrites is None:
+            overwrites = self._overwrites[channel.id] = channel_overwrites(channel)
+            self._visible[channel.id] = {}
+        if user_id in overwrites or user_id == channel.guild.owner_id:
+            return sees_channel(channel.guild, overwrites, user_id, role_ids)
+        cache = self._visible[channel.id]
+        visible = cache.get(role_ids)
+        if visible is None:
+            visible = cache[role_ids] = sees_channel(channel.guild, overwrites, user_id, role_ids)
+        return visible
+
+    def invalidate_channel(self, channel_id: int) -> None:
+        self._overwrites.pop(channel_id, None)
+        self._visible.pop(channel_id, None)
+
+    def clear(self) -> None:
+        self._overwrites.clear()
+        self._visible.clear()
+
+visibility = VisibilityCache()
+
+@bot.event
+async def on_guild_channel_update(before: discord.abc.GuildChannel, after: discord.abc.GuildChannel):
+    visibility.invalidate_channel(after.id)
+
+@bot.event
+async def on_guild_channel_delete(channel: discord.abc.GuildChannel):
+    visibility.invalidate_channel(channel.id)
+
+@bot.event
+async def on_guild_role_create(role: discord.Role):
+    visibility.clear()
+
+@bot.event
+async def on_guild_role_update(before: discord.Role, after: discord.Role):
+    visibility.clear()
+
+@bot.event
+async def on_guild_role_delete(role: discord.Role):
+    visibility.clear()
+
+@bot.event
+async def on_guild_update(before: discord.Guild, after: discord.Guild):
+    visibility.clear()  # например, сменился владелец
+
+# --------- Движки планировщика ----------
+# Оба движка дают одинаковый API: at() — однократно, weekly() — по дням недели, remove().
+# Джобы вызываются так же, как раньше: func(*args), например do_send(rid).
+WEEK_SECONDS = 7 * 24 * 3600
+EPOCH_MONDAY = 4 * 24 * 3600  # 1970-01-05 — первый понедельник эпохи
+MISFIRE_GRACE_SECONDS = 1     # как misfire_grace_time по умолчанию в APScheduler
+
+def utc_timestamp(dt: datetime) -> float:
+    """Наивные datetime в боте — UTC."""
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=timezone.utc)
+    return dt.timestamp()
+
+class APSchedulerEngine:
+    """Движок по умолчанию: по джобу APScheduler (DateTrigger/CronTrigger) на напоминание.
+    Триггерам зона передаётся явно: без неё они берут get_localzone() хоста, а не зону
+    планировщика, и наивное UTC-время из БД сдвигается на смещение хоста."""
+
+    def __init__(self) -> None:
+        self._scheduler = AsyncIOScheduler(timezone=timezone.utc)  # все времена в БД — UTC
+        self._scheduler.add_listener(self._on_submitted, EVENT_JOB_SUBMITTED)
+        self._lag = metrics.histogram("bot_scheduler_lag_seconds")
+
+    def _on_submitted(self, event: JobSubmissionEvent) -> None:
+        now = datetime.now(timezone.utc)
+        for planned in event.scheduled_run_times:
+            self._lag.observe(max(0.0, (now - planned).total_seconds()))
+
+    @property
+    def running(self) -> bool:
+        return self._scheduler.running
+
+    def start(self) -> None:
+        self._scheduler.start()
+
+    def shutdown(self) -> None:
+        self._scheduler.shutdown(wait=False)
+
+    @contextmanager
+    def batch(self) -> Iterator[None]:
+        """Пачка add_job без пробуждения планировщика на каждый джоб."""
+        if not self._scheduler.running:
+            yield
+            return
+        self._scheduler.pause()
+        try:
+            yield
+        finally:
+            self._scheduler.resume()
+
+    def at(self, job_id: str, run_at: datetime, func: Callable, *args, late_ok: bool = False) -> None:
+        extra = {"misfire_grace_time": None} if late_ok else {}
+        trigger = DateTrigger(run_date=run_at, timezone=timezone.utc)
+        self._scheduler.add_job(func, trigger, args=list(args), id=job_id, replace_existing=True, **extra)
+
+    def weekly(self, job_id: str, days: List[str], hh: int, mm: int, func: Callable, *args) -> None:
+        trigger = CronTrigger(day_of_week=",".join(days), hour=hh, minute=mm, timezone=timezone.utc)
+        self._scheduler.add_job(func, trigger, args=list(args), id=job_id, replace_existing=True)
+
+    def remove(self, job_id: str) -> None:
+        try:
+            self._scheduler.remove_job(job_id)
+        except JobLookupError:
+            pass
+
+    def next_run(self, job_id: str) -> Optional[float]:
+        """Ближайшее срабатывание джоба (UTC timestamp) или None."""
+        job = self._scheduler.get_job(job_id)
+        next_run_time = getattr(job, "next_run_time", None)
+        return next_run_time.timestamp() if next_run_time else None
+
+class _HeapJob:
+    __slots__ = ("func", "args", "next_ts", "seq", "offsets", "late_ok")
+
+    def __init__(self, func: Callable, args: Tuple, next_ts: float, offsets: Optional[List[int]], late_ok: bool) -> None:
+        self.func = func
+        self.args = args
+        self.next_ts = next_ts
+        self.seq = 0
+        self.offsets = offsets  # секунды от начала недели (пн 00:00 UTC), отсортированы; None — однократный
+        self.late_ok = late_ok
+
+class HeapEngine:
+    """Собственный планировщик: куча (next_fire_ts, seq, job_id) и один таймер на ближайшее
+    срабатывание. Всё, что наступило к пробуждению, уходит одной пачкой в dispatch();
+    следующее срабатывание еженедельного правила считается бисекцией по смещениям недели."""
+
+    def __init__(self) -> None:
+        self._heap: List[Tuple[float, int, str]] = []
+        self._jobs: Dict[str, _HeapJob] = {}
+        self._seq = itertools.count()
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self._batching = False
+        self._lag = metrics.histogram("bot_scheduler_lag_seconds")
+        self._running: Set[asyncio.Task] = set()  # запущенные джобы, чтобы их не собрал GC
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    def shutdown(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    @contextmanager
+    def batch(self) -> Iterator[None]:
+        """Пачка постановок с одним пересчётом таймера в конце."""
+        self._batching = True
+        try:
+            yield
+        finally:
+            self._batching = False
+            self._wakeup.set()
+
+    @staticmethod
+    def next_weekly(offsets: List[int], after_ts: float) -> float:
+        pos = (after_ts - EPOCH_MONDAY) % WEEK_SECONDS
+        i = bisect_right(offsets, pos)
+        if i < len(offsets):
+            return after_ts - pos + offsets[i]
+        return after_ts - pos + WEEK_SECONDS + offsets[0]
+
+    def _push(self, job_id: str, job: _HeapJob) -> None:
+        job.seq = next(self._seq)
+        self._jobs[job_id] = job
+        heapq.heappush(self._heap, (job.next_ts, job.seq, job_id))
+        if len(self._heap) > 2 * len(self._jobs) + 1024:
+            # слишком много устаревших записей — пересобираем кучу
+            self._heap = [(j.next_ts, j.seq, jid) for jid, j in self._jobs.items()]
+            heapq.heapify(self._heap)
+        if self._heap[0][2] == job_id and not self._batching:
+            self._wakeup.set()  # новый джоб раньше текущего таймера
+
+    def at(self, job_id: str, run_at: datetime, func: Callable, *args, late_ok: bool = False) -> None:
+        self._push(job_id, _HeapJob(func, args, utc_timestamp(run_at), None, late_ok))
+
+    def weekly(self, job_id: str, days: List[str], hh: int, mm: int, func: Callable, *args) -> None:
+        offsets = sorted(DAY_ORDER.index(d) * 86400 + hh * 3600 + mm * 60 for d in days)
+        if not offsets:
+            self.remove(job_id)
+            return
+        self._push(job_id, _HeapJob(func, args, self.next_weekly(offsets, time.time()), offsets, False))
+
+    def remove(self, job_id: str) -> None:
+        # запись в куче остаётся и отбрасывается при извлечении (ленивое удаление)
+        self._jobs.pop(job_id, None)
+
+    def next_run(self, job_id: str) -> Optional[float]:
+        """Ближайшее срабатывание джоба (UTC timestamp) или None."""
+        job = self._jobs.get(job_id)
+        return job.next_ts if job else None
+
+    def _pop_due(self, now: float) -> List[Tuple[Callable, Tuple]]:
+        batch: List[Tuple[Callable, Tuple]] = []
+        while self._heap and self._heap[0][0] <= now:
+            ts, seq, job_id = heapq.heappop(self._heap)
+            job = self._jobs.get(job_id)
+            if job is None or job.seq != seq:
+                continue  # удалён или перепланирован
+            if job.offsets is None:
+                del self._jobs[job_id]
+                if not job.late_ok and now - ts > MISFIRE_GRACE_SECONDS:
+                    print(f"⚠️ Пропущен запуск {job_id}: опоздание {now - ts:.0f} c")
+                    continue
+            else:
+                job.next_ts = self.next_weekly(job.offsets, max(ts, now))
+                job.seq = next(self._seq)
+                heapq.heappush(self._heap, (job.next_ts, job.seq, job_id))
+            self._lag.observe(now - ts)
+            batch.append((job.func, job.args))
+        return batch
+
+    def dispatch(self, batch: List[Tuple[Callable, Tuple]]) -> None:
+        for func, args in batch:
+            task = asyncio.create_task(self._call(func, args))
+            self._running.add(task)
+            task.add_done_callback(self._running.discard)
+
+    @staticmethod
+    async def _call(func: Callable, args: Tuple) -> None:
+        try:
+            await func(*args)
+        except Exception as e:
+            print(f"⚠️ Ошибка в задаче {getattr(func, '__name__', func)}{args}: {e}")
+
+    async def _run(self) -> None:
+        while True:
+            timeout = self._heap[0][0] - time.time() if self._heap else None
+            if timeout is None or timeout > 0:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=timeout)
+                except asyncio.TimeoutError:
+                    pass
+            batch = self._pop_due(time.time())
+            if batch:
+                self.dispatch(batch)
+
+scheduler = HeapEngine() if SCHEDULER_ENGINE == "heap" else APSchedulerEngine()
+
+# --------- Планирование ----------
+async def post_ack_message(channel: discord.TextChannel, rid: int, role: Optional[discord.Role], message: str) -> Optional[int]:
+    """Публикует ACK-сообщение с ✅ и регистрирует его в ack_index. Возвращает id сообщения."""
+    try:
+        mention = role.mention if role else ""
+        ack_msg = await channel.send(f"[ACK {rid}] {mention} {message}\nНажмите {ACK_EMOJI}, если НЕ хотите получать ЛС по этому напоминанию.")
+        await ack_index.register(ack_msg.id, rid)
+        await ack_msg.add_reaction(ACK_EMOJI)
+        return ack_msg.id
+    except Exception:
+        return None
+
+async def post_ack(reminder_id: int, deliver_at: Optional[datetime] = None) -> None:
+    """Фаза 1 (T-5 мин): публикует ACK и сохраняет ожидающую отправку, сам джоб сразу завершается.
+    deliver_at (наивное UTC) передаёт догоняющий движок, когда ACK публикуется с опозданием."""
+    row = await db_fetchone("SELECT * FROM reminders WHERE id=? AND active=1", (reminder_id,))
+    if not row:
+        return
+    if deliver_at is None:
+        deliver_at = datetime.utcnow().replace(second=0, microsecond=0) + timedelta(minutes=ACK_WINDOW_MINUTES)
+
+    ack_message_id: Optional[int] = None
+    guild = bot.get_guild(row["guild_id"])
+    channel = bot.get_channel(CHANNEL_ID)
+    if guild and isinstance(channel, discord.TextChannel):
+        role = guild.get_role(row["role_id"]) if row["kind"] == "role" and row["role_id"] else None
+        with metrics.timer("bot_phase_seconds", phase="ack_post"):
+            ack_message_id = await post_ack_message(channel, reminder_id, role, row["message"])
+
+    # даже без ACK-сообщения отправка не должна потеряться
+    await db_execute(
+        "INSERT OR REPLACE INTO pending_deliveries(reminder_id, deliver_at, ack_message_id, created_at) VALUES (?,?,?,?)",
+        (reminder_id, deliver_at.isoformat(), ack_message_id, datetime.utcnow().isoformat()),
+    )
+    schedule_delivery(reminder_id, deliver_at.isoformat())
+
+async def deliver_pending(reminder_id: int, deliver_at: str) -> None:
+    """Фаза 2 (T): отправка по сохранённому ACK-сообщению."""
+    pending = await db_fetchone(
+        "SELECT ack_message_id, created_at FROM pending_deliveries WHERE reminder_id=? AND deliver_at=?",
+        (reminder_id, deliver_at),
+    )
+    if not pending:
+        return
+    # сколько реально прошло между публикацией ACK и отправкой
+    waited = datetime.utcnow() - datetime.fromisoformat(pending["created_at"])
+    metrics.histogram("bot_phase_seconds", phase="ack_wait").observe(waited.total_seconds())
+    await do_send(reminder_id, pending["ack_message_id"])
+    write_behind.submit("DELETE FROM pending_deliveries WHERE reminder_id=? AND deliver_at=?", (reminder_id, deliver_at))
+
+def schedule_delivery(reminder_id: int, deliver_at: str) -> None:
+    run_at = max(datetime.fromisoformat(deliver_at), datetime.utcnow())
+    # отправка обязана состояться, даже с опозданием
+    scheduler.at(f"deliver_{reminder_id}_{deliver_at}", run_at, deliver_pending, reminder_id, deliver_at, late_ok=True)
+
+async def resume_pending_deliveries() -> None:
+    """После перезапуска доводит до конца отправки, чей ACK уже опубликован."""
+    for r in await db_fetchall("SELECT reminder_id, deliver_at FROM pending_deliveries"):
+        schedule_delivery(r["reminder_id"], r["deliver_at"])
+
+class Delivery:
+    """Одно сработавшее напоминание, готовое к отправке."""
+
+    __slots__ = ("row", "guild", "channel", "role", "ack_message_id", "reacted_ids")
+
+    def __init__(self, row: sqlite3.Row, guild: discord.Guild, channel: discord.TextChannel, ack_message_id: Optional[int]) -> None:
+        self.row = row
+        self.guild = guild
+        self.channel = channel
+        self.role: Optional[discord.Role] = guild.get_role(row["role_id"]) if row["role_id"] else None
+        self.ack_message_id = ack_message_id
+        # Реакции на ACK уже собраны ack_index за время между фазами
+        self.reacted_ids: Set[int] = ack_index.reacted(ack_message_id) if row["ack_required"] else set()
+
+    @property
+    def group_key(self) -> Tuple:
+        """Напоминания с одинаковым ключом можно отправить одним сообщением."""
+        target = self.row["role_id"] if self.row["kind"] == "role" else self.row["target_user_id"]
+        return (self.guild.id, self.row["kind"], target)
+
+async def prepare_delivery(reminder_id: int, ack_message_id: Optional[int]) -> Optional[Delivery]:
+    d = await _resolve_delivery(reminder_id, ack_message_id)
+    if d is None and ack_message_id is not None:
+        # отправки не будет — реакции на этот ACK больше не нужны
+        ack_index.forget(ack_message_id)
+    return d
+
+async def _resolve_delivery(reminder_id: int, ack_message_id: Optional[int]) -> Optional[Delivery]:
+    start = time.perf_counter()
+    row = await db_fetchone("SELECT * FROM reminders WHERE id=? AND active=1", (reminder_id,))
+    if not row:
+        return None
+
+    guild = bot.get_guild(row["guild_id"])
+    if not guild:
+        return None
+
+    channel = bot.get_channel(CHANNEL_ID)
+    if not isinstance(channel, discord.TextChannel):
+        return None
+
+    # kind == 'dm' без цели — отправлять некому
+    if row["kind"] == "dm" and not row["target_user_id"]:
+        return None
+
+    await member_index.wait_ready(guild.id)
+    metrics.histogram("bot_phase_seconds", phase="prepare").observe(time.perf_counter() - start)
+    return Delivery(row, guild, channel, ack_message_id)
+
+def delivery_recipients(d: Delivery) -> List[int]:
+    """Кому уходит ЛС: все, кроме ботов и тех, кто видит канал и поставил ✅."""
+    ack_required = bool(d.row["ack_required"])
+    recipients: List[int] = []
+    if d.row["kind"] == "role":
+        if d.role is None:
+            return recipients
+        for uid in member_index.role_members(d.role.id):
+            if member_index.is_bot(uid):
+                continue
+            if ack_required and uid in d.reacted_ids and visibility.sees(d.channel, uid, member_index.member_roles(d.guild.id, uid) or ()):
+                continue
+            recipients.append(uid)
+    else:
+        # kind == 'dm' — одно целевое лицо
+        uid = d.row["target_user_id"]
+        member_roles = member_index.member_roles(d.guild.id, uid)
+        if member_roles is not None and not member_index.is_bot(uid):
+            if not (ack_required and uid in d.reacted_ids and visibility.sees(d.channel, uid, member_roles)):
+                recipients.append(uid)
+    return recipients
+
+def delivery_writes(d: Delivery, fired: datetime) -> List[Tuple[str, Tuple]]:
+    """Изменения состояния, которые фиксируются вместе с постановкой пачки в outbox."""
+    writes: List[Tuple[str, Tuple]] = [("UPDATE reminders SET last_fired_at=? WHERE id=?", (fired.isoformat(), d.row["id"]))]
+    # Если одноразовое — деактивируем
+    if d.row["mode"] == "one":
+        writes.append(("UPDATE reminders SET active=0, updated_at=? WHERE id=?", (datetime.utcnow().isoformat(), d.row["id"])))
+    # Фаза ACK завершена: дальше отправку ведёт outbox
+    if d.row["ack_required"]:
+        writes.append(("DELETE FROM pending_deliveries WHERE reminder_id=? AND ack_message_id IS ?", (d.row["id"], d.ack_message_id)))
+    return writes
+
+async def deliver_group(deliveries: List[Delivery], fired: Optional[datetime] = None) -> Dict[int, DeliveryReport]:
+    """Отправляет напоминания с общим получателем: один пост в канал на роль и одно ЛС на
+    участника со всеми текстами, которые ему положены. ЛС идут через outbox, история пишется
+    по каждому напоминанию. Для одного напоминания это ровно прежняя отправка.
+    fired — плановое время срабатывания (для догоняющих отправок), по умолчанию сейчас.
+    Возвращает отчёт по каждому напоминанию группы."""
+    fired = (fired or datetime.utcnow()).replace(second=0, microsecond=0)
+    first = deliveries[0]
+    text = "\n".join(d.row["message"] for d in deliveries)
+
+    if first.row["kind"] == "role":
+        # Публикуем основное сообщение в канал (с тегом роли)
+        with metrics.timer("bot_phase_seconds", phase="post"):
+            if first.role is not None:
+                await first.channel.send(f"{first.role.mention} {text}")
+            else:
+                await first.channel.send(text)
+
+    per_member: Dict[int, Tuple[int, ...]] = {}
+    for d in deliveries:
+        for uid in delivery_recipients(d):
+            per_member[uid] = per_member.get(uid, ()) + (d.row["id"],)
+
+    # одинаковые наборы текстов — одна строка на всех
+    messages = {d.row["id"]: d.row["message"] for d in deliveries}
+    contents: Dict[Tuple[int, ...], str] = {}
+    items = []
+    for uid, rids in per_member.items():
+        content = contents.get(rids)
+        if content is None:
+            content = contents[rids] = "\n\n".join(messages[rid] for rid in rids)
+        items.append((uid, content, rids))
+
+    fired_key = fired.strftime("%Y-%m-%dT%H:%M")
+    key = "+".join(
+        f"{d.row['id']}:{d.ack_message_id}" if d.ack_message_id is not None else f"{d.row['id']}@{fired_key}"
+        for d in deliveries
+    )
+    payload = [
+        {"reminder_id": d.row["id"], "guild_id": d.guild.id, "ack_message_id": d.ack_message_id, "reacted": len(d.reacted_ids)}
+        for d in deliveries
+    ]
+    writes = [w for d in deliveries for w in delivery_writes(d, fired)]
+    with metrics.timer("bot_phase_seconds", phase="fanout"):
+        done = await outbox.enqueue(key, payload, items, writes)
+        for d in deliveries:
+            if d.ack_message_id is not None:
+                ack_index.forget(d.ack_message_id)
+            if d.row["mode"] == "one":
+                # одноразовое деактивировано вместе с постановкой в outbox
+                member_index.untrack(d.row["id"])
+        return await done
+
+class DeliveryCoalescer:
+    """Склейка отправок (COALESCE_DELIVERIES=1): всё, что пришло в do_send за COALESCE_WINDOW
+    секунд, группируется по получателю (роль или пользователь) и уходит через deliver_group.
+    Группы, которые не влезают в лимит длины сообщения, отправляются по одному."""
+
+    def __init__(self, window: float) -> None:
+        self.window = window
+        self._pending: List[Tuple[int, Optional[int], asyncio.Future]] = []
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._tasks: Set[asyncio.Task] = set()
+
+    def submit(self, reminder_id: int, ack_message_id: Optional[int]) -> asyncio.Future:
+        loop = asyncio.get_running_loop()
+        fut = loop.create_future()
+        self._pending.append((reminder_id, ack_message_id, fut))
+        if self._timer is None:
+            self._timer = loop.call_later(self.window, self._flush)
+        return fut
+
+    def _flush(self) -> None:
+        batch, self._pending, self._timer = self._pending, [], None
+        task = asyncio.create_task(self._deliver(batch))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _deliver(self, batch: List[Tuple[int, Optional[int], asyncio.Future]]) -> None:
+        reports: Dict[int, DeliveryReport] = {}
+        try:
+            prepared = await asyncio.gather(
+                *(prepare_delivery(rid, ack_id) for rid, ack_id, _ in batch), return_exceptions=True
+            )
+            groups: Dict[Tuple, List[Delivery]] = {}
+            for (rid, _, _), d in zip(batch, prepared):
+                if isinstance(d, Exception):
+                    print(f"⚠️ Ошибка подготовки отправки RID {rid}: {d}")
+                elif d is not None:
+                    groups.setdefault(d.group_key, []).append(d)
+            jobs = []
+            for group in groups.values():
+                if len(group) > 1 and sum(len(d.row["message"]) + 2 for d in group) > COALESCE_MAX_LENGTH:
+                    jobs.extend(deliver_group([d]) for d in group)
+                else:
+                    jobs.append(deliver_group(group))
+            results = await asyncio.gather(*jobs, return_exceptions=True)
+            for r in results:
+                if isinstance(r, Exception):
+                    print(f"⚠️ Ошибка склеенной отправки: {r}")
+                else:
+                    reports.update(r)
+        finally:
+            for rid, _, fut in batch:
+                if not fut.done():
+                    fut.set_result(reports.get(rid))
+
+coalescer = DeliveryCoalescer(COALESCE_WINDOW)
+
+async def do_send(reminder_id: int, ack_message_id: Optional[int] = None) -> Optional[DeliveryReport]:
+    """Основная отправка напоминания (однократная или еженедельная).
+    ack_message_id — ACK, опубликованный заранее фазой post_ack (если ack включён).
+    Возвращает отчёт по получателям или None, если отправлять было некуда."""
+    if COALESCE_DELIVERIES:
+        report = await coalescer.submit(reminder_id, ack_message_id)
+    else:
+        d = await prepare_delivery(reminder_id, ack_message_id)
+        report = (await deliver_group([d])).get(reminder_id) if d is not None else None
+    if report is not None and report.dm_failed:
+        print(f"⚠️ RID {reminder_id}: ЛС не доставлено {report.dm_failed} из {report.recipients}")
+    return report
+
+def schedule_reminder(row: sqlite3.Row) -> None:
+    """Ставит задачи в планировщик в зависимости от режима и ack.
+    Без ack джоб сразу отправляет; с ack — только публикует ACK за 5 минут, а отправку
+    планирует отдельным джобом (см. post_ack)."""
+    rid = row["id"]
+    mode = row["mode"]
+    ack_required = bool(row["ack_required"])
+    func = post_ack if ack_required else do_send
+    member_index.track(row)
+
+    if mode == "one":
+        run_at = dateparser.parse(row["run_at"])
+        if ack_required:
+            run_at = run_at - timedelta(minutes=ACK_WINDOW_MINUTES)
+        if utc_timestamp(run_at) <= time.time():
+            # время джоба уже прошло: при старте решает догоняющий движок,
+            # при reconcile уже запланированный джоб отработал или отрабатывает сам
+            if not reminder_loader.loaded:
+                catchup.add_one(row)
+            return
+        scheduler.at(f"rem_{rid}", run_at, func, rid)
+    else:
+        # weekly: считаем время старта джоба (если ack — минус 5 минут + сдвиг дня)
+        days = [d.strip() for d in row["weekly_days"].split(",") if d.strip()]
+        days = [d for d in days if d in DAY_ORDER]
+        hh, mm = parse_hhmm(row["weekly_time"])
+        if ack_required:
+            day_shift, hh, mm = adjust_time_minus_minutes(hh, mm, ACK_WINDOW_MINUTES)
+            if day_shift != 0:
+                # сдвиг на предыдущий день
+                days = [prev_day(d) for d in days]
+        scheduler.weekly(f"rem_{rid}", days, hh, mm, func, rid)
+
+def unschedule_reminder(rid: int) -> None:
+    scheduler.remove(f"rem_{rid}")
+    member_index.untrack(rid)
+
+def schedule_reminders(rows: Iterable[sqlite3.Row]) -> None:
+    with scheduler.batch():
+        for r in rows:
+            schedule_reminder(r)
+
+class ReminderLoader:
+    """Загрузка напоминаний в планировщик. Полная загрузка — один раз за процесс, потоково
+    пачками по REMINDER_LOAD_BATCH с передачей управления loop между ними. После
+    переподключения — только строки с updated_at новее водяного знака."""
+
+    LOAD_QUERY = "SELECT * FROM reminders WHERE active=1 AND id>? ORDER BY id LIMIT ?"  # idx_reminders_active
+
+    def __init__(self) -> None:
+        self.loaded = False
+        self.watermark = ""
+        self._lock = asyncio.Lock()
+
+    async def load_all(self) -> int:
+        async with self._lock:
+            if self.loaded:
+                return 0
+            # знак берём до чтения: всё, что поменяется во время загрузки, догрузит reconcile
+            top = await db_fetchone("SELECT max(updated_at) AS m FROM reminders")
+            count = 0
+            async for r in db_stream(
+                self.LOAD_QUERY, (), (0,), lambda r: (r["id"],),
+            ):
+                schedule_reminder(r)
+                if r["mode"] == "weekly":
+                    catchup.add_weekly(r)
+                count += 1
+            self.watermark = (top["m"] if top else None) or ""
+            self.loaded = True
+            catchup.start()
+            return count
+
+    async def reconcile(self) -> int:
+        async with self._lock:
+            # строки ровно на водяном знаке применятся ещё раз — schedule_reminder идемпотентен
+            count = 0
+            async for r in db_stream(
+                """SELECT * FROM reminders
+                   WHERE (updated_at, id) > (?, ?)
+                   ORDER BY updated_at, id LIMIT ?""",
+                (), (self.watermark, 0), lambda r: (r["updated_at"], r["id"]),
+            ):
+                if r["active"]:
+                    schedule_reminder(r)
+                else:
+                    unschedule_reminder(r["id"])
+                self.watermark = max(self.watermark, r["updated_at"])
+                count += 1
+            return count
+
+reminder_loader = ReminderLoader()
+
+# --------- Догоняющие отправки ----------
+class CatchUp:
+    """Срабатывания, пропущенные, пока бот был выключен. Для каждого напоминания действует
+    политика (reminders.catchup_policy или CATCHUP_POLICY): 'skip' — пропустить, 'fire-once' —
+    отправить один раз, 'fire-all' — отправить каждое пропущенное срабатывание (не старше
+    CATCHUP_MAX_AGE_HOURS). Очередь разбирается по приоритету — сначала однократные, затем по
+    времени срабатывания — не чаще раза в CATCHUP_INTERVAL и только пока живая очередь ЛС мала.
+    Если пропущен только ACK (T-5), а сама отправка T ещё впереди, ACK публикуется сразу и
+    отправка идёт штатно в T — это не пропуск, политика тут не применяется."""
+
+    def __init__(self) -> None:
+        self._heap: List[Tuple[int, float, int, int]] = []  # (приоритет, срабатывание, seq, reminder_id)
+        self._seq = itertools.count()
+        self._task: Optional[asyncio.Task] = None
+        self._queued_one: Set[int] = set()
+        self._acks: Set[asyncio.Task] = set()
+
+    def __len__(self) -> int:
+        return len(self._heap)
+
+    @staticmethod
+    def _policy(row: sqlite3.Row) -> str:
+        return row["catchup_policy"] or CATCHUP_POLICY
+
+    def _push(self, priority: int, due_ts: float, rid: int) -> None:
+        heapq.heappush(self._heap, (priority, due_ts, next(self._seq), rid))
+
+    def _ack_late(self, rid: int, due_ts: float) -> None:
+        task = asyncio.create_task(self._post_late_ack(rid, due_ts))
+        self._acks.add(task)
+        task.add_done_callback(self._acks.discard)
+
+    async def _post_late_ack(self, rid: int, due_ts: float) -> None:
+        # ACK уже опубликован до остановки — доставку ведёт resume_pending_deliveries
+        if await db_fetchone("SELECT 1 FROM pending_deliveries WHERE reminder_id=?", (rid,)):
+            return
+        try:
+            await post_ack(rid, datetime.utcfromtimestamp(due_ts).replace(second=0, microsecond=0))
+        except Exception as e:
+            print(f"⚠️ Ошибка запоздалого ACK RID {rid}: {e}")
+
+    def add_one(self, row: sqlite3.Row) -> None:
+        """Однократное напоминание, чей джоб уже должен был сработать."""
+        due_ts = utc_timestamp(dateparser.parse(row["run_at"]))
+        if row["id"] in self._queued_one:
+            return
+        if row["ack_required"] and due_ts > time.time():
+            self._ack_late(row["id"], due_ts)
+            return
+        if self._policy(row) == "skip" or due_ts < time.time() - CATCHUP_MAX_AGE_HOURS * 3600:
+            write_behind.submit("UPDATE reminders SET active=0, updated_at=? WHERE id=?", (datetime.utcnow().isoformat(), row["id"]))
+            member_index.untrack(row["id"])
+            return
+        self._queued_one.add(row["id"])
+        self._push(0, due_ts, row["id"])
+
+    def add_weekly(self, row: sqlite3.Row) -> None:
+        """Еженедельные срабатывания между последней отправкой и текущим моментом."""
+        policy = self._policy(row)
+        days = [d for d in (x.strip() for x in row["weekly_days"].split(",")) if d in DAY_ORDER]
+        hh, mm = parse_hhmm(row["weekly_time"])
+        offsets = sorted(DAY_ORDER.index(d) * 86400 + hh * 3600 + mm * 60 for d in days)
+        if not offsets:
+            return
+        now = time.time()
+        # джоб с ack срабатывает на ACK_WINDOW_MINUTES раньше отправки
+        lead = ACK_WINDOW_MINUTES * 60 if row["ack_required"] else 0
+        since = row["last_fired_at"] or row["updated_at"] or row["created_at"]
+        ts = max(utc_timestamp(datetime.fromisoformat(since)), now - CATCHUP_MAX_AGE_HOURS * 3600)
+        missed: List[float] = []
+        while True:
+            ts = HeapEngine.next_weekly(offsets, ts)
+            if ts - lead > now:
+                break
+            if ts > now:
+                # пропущен только ACK, отправка ещё впереди
+                self._ack_late(row["id"], ts)
+                break
+            missed.append(ts)
+        if policy == "skip":
+            return
+        if policy != "fire-all":
+            missed = missed[-1:]
+        for due_ts in missed:
+            self._push(1, due_ts, row["id"])
+
+    def start(self) -> None:
+        if self._heap and self._task is None:
+            self._task = asyncio.create_task(self._drain())
+
+    async def _drain(self) -> None:
+        try:
+            while self._heap:
+                # не мешаем живым отправкам
+                while outbox.pending() > CATCHUP_OUTBOX_LIMIT:
+                    await asyncio.sleep(CATCHUP_INTERVAL)
+                priority, due_ts, _, rid = heapq.heappop(self._heap)
+                if priority == 0:
+                    self._queued_one.discard(rid)
+                # ACK уже опубликован до остановки — доставку ведёт resume_pending_deliveries
+                if await db_fetchone("SELECT 1 FROM pending_deliveries WHERE reminder_id=?", (rid,)):
+                    continue
+                try:
+                    await deliver_catchup(rid, datetime.utcfromtimestamp(due_ts))
+                except Exception as e:
+                    print(f"⚠️ Ошибка догоняющей отправки RID {rid}: {e}")
+                await asyncio.sleep(CATCHUP_INTERVAL)
+        finally:
+            self._task = None
+
+catchup = CatchUp()
+metrics.gauge("bot_catchup_backlog", lambda: len(catchup))
+
+async def deliver_catchup(reminder_id: int, due: datetime) -> None:
+    """Пропущенное срабатывание: сразу отправка, без фазы ACK."""
+    d = await prepare_delivery(reminder_id, None)
+    if d is not None:
+        print(f"⏪ Догоняющая отправка RID {reminder_id} за {due.isoformat()}")
+        await deliver_group([d], fired=due)
+
+# --------- Прогноз нагрузки ----------
+MINUTES_PER_WEEK = 7 * 24 * 60
+
+class Forecast:
+    """Поминутный прогноз на horizon минут от start: ЛС, все запросы к API (ЛС, посты в канал,
+    ACK-сообщения с реакцией) и очередь, которая копится, когда запросов больше capacity."""
+
+    __slots__ = ("start", "dms", "requests", "capacity", "backlog", "minutes", "reminder_ids", "guild_ids", "unknown")
+
+    def __init__(self, start: datetime, horizon: int) -> None:
+        self.start = start
+        self.dms = np.zeros(horizon)
+        self.requests = np.zeros(horizon)
+        self.backlog = np.zeros(horizon)
+        self.capacity = DM_GLOBAL_RATE * 60
+        self.minutes = np.zeros(0, dtype=np.int64)       # минута каждого срабатывания
+        self.reminder_ids = np.zeros(0, dtype=np.int64)  # ...и его напоминание
+        self.guild_ids = np.zeros(0, dtype=np.int64)
+        self.unknown = 0  # ролевых напоминаний, чей размер роли ещё неизвестен (индекс не построен)
+
+    def at(self, minute: int) -> datetime:
+        return self.start + timedelta(minutes=int(minute))
+
+    def hotspots(self, limit: int) -> List[int]:
+        """Минуты, где запросов больше capacity, — от самых тяжёлых."""
+        over = np.flatnonzero(self.requests > self.capacity)
+        return over[np.argsort(-self.requests[over], kind="stable")][:limit].tolist()
+
+    def firing(self, minute: int, guild_id: Optional[int] = None) -> List[int]:
+        mask = self.minutes == minute
+        if guild_id is not None:
+            mask &= self.guild_ids == guild_id
+        return sorted(set(self.reminder_ids[mask].tolist()))
+
+async def forecast_load(horizon: int) -> Forecast:
+    """Разворачивает расписания всех активных напоминаний на horizon минут вперёд и считает
+    поминутную нагрузку. Разбор строк — построчно, всё остальное — векторно по срабатываниям.
+    Размер роли берётся из индекса участников (с ботами, т.е. оценка сверху), ACK-напоминания
+    считаются так, будто ✅ никто не поставил."""
+    rows = await db_fetchall(
+        """SELECT id, guild_id, kind, role_id, target_user_id, mode, run_at, weekly_days, weekly_time, ack_required
+           FROM reminders WHERE active=1"""
+    )
+    start_min = int(time.time() // 60)
+    fc = Forecast(datetime.utcfromtimestamp(start_min * 60), horizon)
+    week_pos = (start_min - int(EPOCH_MONDAY // 60)) % MINUTES_PER_WEEK
+
+    n = len(rows)
+    ids = np.zeros(n, dtype=np.int64)
+    guilds = np.zeros(n, dtype=np.int64)
+    targets = np.zeros(n, dtype=np.int64)
+    sizes = np.zeros(n)
+    is_role = np.zeros(n, dtype=bool)
+    acks = np.zeros(n, dtype=bool)
+    weekly_idx: List[int] = []
+    weekly_off: List[int] = []  # минута недели (пн 00:00 UTC = 0)
+    once_idx: List[int] = []
+    once_min: List[int] = []
+    for i, r in enumerate(rows):
+        ids[i], guilds[i], acks[i] = r["id"], r["guild_id"], bool(r["ack_required"])
+        if r["kind"] == "role":
+            is_role[i] = True
+            targets[i] = r["role_id"] or 0
+            sizes[i] = len(member_index.role_members(r["role_id"])) if r["role_id"] else 0
+            if not member_index.indexed(r["guild_id"]):
+                fc.unknown += 1
+        else:
+            targets[i] = r["target_user_id"] or 0
+            sizes[i] = 1 if r["target_user_id"] else 0
+        try:
+            if r["mode"] == "one":
+                once_min.append(int(utc_timestamp(dateparser.parse(r["run_at"])) // 60) - start_min)
+                once_idx.append(i)
+            else:
+                hh, mm = parse_hhmm(r["weekly_time"])
+                for d in (x.strip() for x in r["weekly_days"].split(",")):
+                    if d in DAY_ORDER:
+                        weekly_off.append(DAY_ORDER.index(d) * 1440 + hh * 60 + mm)
+                        weekly_idx.append(i)
+        except (ValueError, OverflowError, TypeError, AttributeError):
+            continue  # строку с битым расписанием планировщик тоже не примет
+
+    # еженедельные: первое срабатывание не раньше текущей минуты, дальше — шагом в неделю
+    weeks = -(-horizon // MINUTES_PER_WEEK) + 1
+    first = (np.asarray(weekly_off, dtype=np.int64) - week_pos) % MINUTES_PER_WEEK
+    weekly_minutes = (first[:, None] + MINUTES_PER_WEEK * np.arange(weeks, dtype=np.int64)[None, :]).ravel()
+    weekly_rem = np.repeat(np.asarray(weekly_idx, dtype=np.int64), weeks)
+    minutes = np.concatenate([weekly_minutes, np.asarray(once_min, dtype=np.int64)])
+    rem = np.concatenate([weekly_rem, np.asarray(once_idx, dtype=np.int64)])
+    keep = (minutes >= 0) & (minutes < horizon)
+    minutes, rem = minutes[keep], rem[keep]
+    fc.minutes, fc.reminder_ids, fc.guild_ids = minutes, ids[rem], guilds[rem]
+
+    # ACK публикуется за ACK_WINDOW_MINUTES до отправки (тот же сдвиг, что adjust_time_minus_minutes
+    # даёт для cron): сообщение + реакция
+    ack_minutes = minutes[acks[rem]] - ACK_WINDOW_MINUTES
+    ack_minutes = ack_minutes[ack_minutes >= 0]
+
+    if COALESCE_DELIVERIES and len(minutes):
+        # склейка: одна отправка на (минута, роль/пользователь)
+        _, first_of = np.unique(np.stack([minutes, targets[rem]]), axis=1, return_index=True)
+        minutes, rem = minutes[first_of], rem[first_of]
+
+    fc.dms = np.bincount(minutes, weights=sizes[rem], minlength=horizon)
+    posts = np.bincount(minutes[is_role[rem]], minlength=horizon)
+    fc.requests = fc.dms + posts + 2 * np.bincount(ack_minutes, minlength=horizon)
+    # очередь по рекурсии Линдли: W_t = max(0, W_{t-1} + x_t - c) через накопленные суммы
+    excess = np.cumsum(fc.requests - fc.capacity)
+    fc.backlog = excess - np.minimum.accumulate(np.minimum(excess, 0))
+    return fc
+
+def forecast_horizon(days: Optional[float]) -> int:
+    days = FORECAST_HORIZON_DAYS if days is None else min(max(days, 1 / 24), 28)
+    return int(days * 1440)
+
+async def forecast_http(request: web.Request) -> web.Response:
+    """GET /forecast?days=N — горячие минуты и итоги в JSON."""
+    try:
+        days = float(request.query["days"]) if "days" in request.query else None
+    except ValueError:
+        raise web.HTTPBadRequest(text="days: ожидалось число")
+    fc = await forecast_load(forecast_horizon(days))
+    peak = int(np.argmax(fc.requests)) if len(fc.requests) else 0
+    return web.json_response({
+        "start": fc.start.isoformat(),
+        "capacity_per_minute": fc.capacity,
+        "total_dms": float(fc.dms.sum()),
+        "peak": {"at": fc.at(peak).isoformat(), "requests": float(fc.requests[peak]) if len(fc.requests) else 0.0},
+        "unknown_role_sizes": fc.unknown,
+        "hotspots": [
+            {"at": fc.at(m).isoformat(), "dms": float(fc.dms[m]), "requests": float(fc.requests[m]),
+             "backlog": float(fc.backlog[m]), "reminders": fc.firing(m)}
+            for m in fc.hotspots(FORECAST_TOP)
+        ],
+    })
+
+metrics.route("/forecast", forecast_http)
+
+# --------- Команды ----------
+@bot.event
+async def on_ready():
+    if CHANNEL_ID == 0:
+        print("⚠️ Переменная окружения CHANNEL_ID не задана!")
+    if not reminder_loader.loaded:
+        loaded = await reminder_loader.load_all()
+        await resume_pending_deliveries()
+        print(f"📥 Загружено напоминаний: {loaded}")
+    else:
+        # переподключение: только изменения после последней загрузки
+        changed = await reminder_loader.reconcile()
+        print(f"🔄 Переподключение, обновлено напоминаний: {changed}")
+    for guild in bot.guilds:
+        await member_index.request(guild.id)
+    print(f"✅ Бот запущен как {bot.user} (готов)")
+
+def ensure_allowed():
+    async def predicate(ctx: commands.Context):
+        if not ctx.guild:
+            await ctx.send("Эту команду можно использовать только на сервере.")
+            return False
+        if await can_create(ctx):
+            return True
+        await ctx.send("⛔ У вас нет прав для этой команды.")
+        return False
+    return commands.check(predicate)
+
+@bot.command(name="add_allowed_user")
+async def add_allowed_user_cmd(ctx: commands.Context, user_id: int):
+    if ctx.author.id != ctx.guild.owner_id:
+        await ctx.send("⛔ Только владелец сервера может добавлять разрешённых.")
+        return
+    await guild_configs.allow(ctx.guild.id, user_id)
+    await ctx.send(f"✅ Пользователь `{user_id}` добавлен в белый список.")
+
+@bot.command(name="remove_allowed_user")
+async def remove_allowed_user_cmd(ctx: commands.Context, user_id: int):
+    if ctx.author.id != ctx.guild.owner_id:
+        await ctx.send("⛔ Только владелец сервера может убирать разрешённых.")
+        return
+    await guild_configs.disallow(ctx.guild.id, user_id)
+    await ctx.send(f"✅ Пользователь `{user_id}` удалён из белого списка.")
+
+# --------- Постраничный вывод и выгрузка ----------
+class KeysetPages:
+    """Постраничный просмотр по ключу: каждая страница — диапазонный запрос по индексу от
+    крайней строки текущей страницы, без OFFSET. older/newer получают (*params, *cursor, limit)
+    и отдают строки после cursor в порядке удаления от него; страница показывается от новых к старым."""
+
+    def __init__(self, older: str, newer: str, params: Tuple, key: Callable[[sqlite3.Row], Tuple], start: Tuple) -> None:
+        self.older_query = older
+        self.newer_query = newer
+        self.params = params
+        self.key = key
+        self.start = start
+        self.rows: List[sqlite3.Row] = []
+        self.has_older = False
+        self.has_newer = False
+
+    async def _fetch(self, query: str, cursor: Tuple) -> Tuple[List[sqlite3.Row], bool]:
+        rows = await db_fetchall(query, self.params + cursor + (PAGE_SIZE + 1,))
+        return rows[:PAGE_SIZE], len(rows) > PAGE_SIZE
+
+    async def first(self) -> List[sqlite3.Row]:
+        self.rows, self.has_older = await self._fetch(self.older_query, self.start)
+        self.has_newer = False
+        return self.rows
+
+    async def older(self) -> List[sqlite3.Row]:
+        rows, more = await self._fetch(self.older_query, self.key(self.rows[-1]))
+        if rows:
+            self.rows, self.has_older, self.has_newer = rows, more, True
+        else:
+            self.has_older = False
+        return self.rows
+
+    async def newer(self) -> List[sqlite3.Row]:
+        rows, more = await self._fetch(self.newer_query, self.key(self.rows[0]))
+        if rows:
+            self.rows, self.has_newer, self.has_older = rows[::-1], more, True
+        else:
+            self.has_newer = False
+        return self.rows
+
+async def send_pages(ctx: commands.Context, pages: KeysetPages, title: str, render: Callable[[sqlite3.Row], str]) -> bool:
+    """Первая страница с кнопками ◀/▶; False, если показывать нечего."""
+    if not await pages.first():
+        return False
+
+    def text() -> str:
+        return f"**{title}:**\n" + "\n".join(render(r) for r in pages.rows)
+
+    prev_btn = Button(label="◀ Новее", style=discord.ButtonStyle.secondary)
+    next_btn = Button(label="Старше ▶", style=discord.ButtonStyle.secondary)
+    view = View(timeout=180)
+
+    def sync_buttons() -> None:
+        prev_btn.disabled = not pages.has_newer
+        next_btn.disabled = not pages.has_older
+
+    async def turn(interaction: discord.Interaction, step: Callable[[], Awaitable[List[sqlite3.Row]]]) -> None:
+        if interaction.user != ctx.author:
+            await interaction.response.send_message("Только инициатор может листать.", ephemeral=True)
+            return
+        await step()
+        sync_buttons()
+        await interaction.response.edit_message(content=text(), view=view)
+
+    async def on_prev(interaction: discord.Interaction):
+        await turn(interaction, pages.newer)
+
+    async def on_next(interaction: discord.Interaction):
+        await turn(interaction, pages.older)
+
+    prev_btn.callback = on_prev
+    next_btn.callback = on_next
+    view.add_item(prev_btn)
+    view.add_item(next_btn)
+    sync_buttons()
+    if pages.has_older:
+        await ctx.send(text(), view=view)
+    else:
+        await ctx.send(text())
+    return True
+
+# (к старым, к новым) для list_reminders и history: диапазоны по idx_reminders_guild_active и idx_history_guild_sent
+REMINDER_PAGES = (
+    "SELECT * FROM reminders WHERE guild_id=? AND active=1 AND id<? ORDER BY id DESC LIMIT ?",
+    "SELECT * FROM reminders WHERE guild_id=? AND active=1 AND id>? ORDER BY id LIMIT ?",
+)
+HISTORY_PAGES = (
+    """SELECT id, reminder_id, sent_at, dm_sent, dm_failed FROM history
+       WHERE guild_id=? AND (sent_at, id) < (?, ?) ORDER BY sent_at DESC, id DESC LIMIT ?""",
+    """SELECT id, reminder_id, sent_at, dm_sent, dm_failed FROM history
+       WHERE guild_id=? AND (sent_at, id) > (?, ?) ORDER BY sent_at, id LIMIT ?""",
+)
+
+def render_reminder(r: sqlite3.Row) -> str:
+    if r["mode"] == "one":
+        when = r["run_at"]
+    else:
+        when = f"{r['weekly_days']} @ {r['weekly_time']}"
+    target = f"role:{r['role_id']}" if r["kind"] == "role" else f"user:{r['target_user_id']}"
+    return f"ID {r['id']} | {target} | {r['mode']} | {when} | ack={r['ack_required']}"
+
+def render_history(r: sqlite3.Row) -> str:
+    failed = f" (не доставлено: {r['dm_failed']})" if r["dm_failed"] else ""
+    return f"RID {r['reminder_id']} — {r['sent_at']} — DM: {r['dm_sent']}{failed}"
+
+# что можно выгрузить: запрос по возрастанию ключа, (*params, *cursor, limit), ключ и начальный курсор
+EXPORTS: Dict[str, Tuple[str, Callable[[sqlite3.Row], Tuple], Tuple]] = {
+    "reminders": (
+        "SELECT * FROM reminders WHERE guild_id=? AND id>? ORDER BY id LIMIT ?",
+        lambda r: (r["id"],), (0,),
+    ),
+    "history": (
+        """SELECT id, reminder_id, sent_at, dm_sent, dm_failed, recipients, ack_message_id, reacted FROM history
+           WHERE guild_id=? AND (sent_at, id) > (?, ?) ORDER BY sent_at, id LIMIT ?""",
+        lambda r: (r["sent_at"], r["id"]), ("", 0),
+    ),
+}
+
+async def export_rows(what: str, guild_id: int, fmt: str, out) -> int:
+    """Пишет строки в out по мере чтения (csv — с заголовком из колонок запроса, jsonl —
+    объект на строку). Возвращает число строк."""
+    query, key, start = EXPORTS[what]
+    writer = csv.writer(out) if fmt == "csv" else None
+    count = 0
+    async for r in db_stream(query, (guild_id,), start, key, EXPORT_BATCH):
+        if writer is not None:
+            if count == 0:
+                writer.writerow(r.keys())
+            writer.writerow(tuple(r))
+        else:
+            out.write(json.dumps(dict(r), ensure_ascii=False) + "\n")
+        count += 1
+    return count
+
+@bot.command(name="list_reminders")
+@ensure_allowed()
+async def list_reminders_cmd(ctx: commands.Context):
+    pages = KeysetPages(*REMINDER_PAGES, (ctx.guild.id,), lambda r: (r["id"],), (2 ** 63 - 1,))
+    if not await send_pages(ctx, pages, "Напоминания", render_reminder):
+        await ctx.send("📭 Активных напоминаний нет.")
+
+@bot.command(name="history")
+@ensure_allowed()
+async def history_cmd(ctx: commands.Context):
+    await write_behind.flush()  # показываем и ещё не сброшенные на диск отправки
+    pages = KeysetPages(*HISTORY_PAGES, (ctx.guild.id,), lambda r: (r["sent_at"], r["id"]), ("\uffff", 0))
+    if not await send_pages(ctx, pages, "История отправок", render_history):
+        await ctx.send("📜 История пуста.")
+
+@bot.command(name="export")
+@ensure_allowed()
+async def export_cmd(ctx: commands.Context, what: str = "reminders", fmt: str = "csv"):
+    """!export reminders|history [csv|jsonl] — полная выгрузка файлом."""
+    what, fmt = what.lower(), fmt.lower()
+    if what not in EXPORTS or fmt not in ("csv", "jsonl"):
+        await ctx.send("Использование: `!export reminders|history [csv|jsonl]`")
+        return
+    if what == "history":
+        await write_behind.flush()
+    fd, path = tempfile.mkstemp(prefix=f"{what}_", suffix=f".{fmt}")
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8", newline="") as out:
+            count = await export_rows(what, ctx.guild.id, fmt, out)
+        if count == 0:
+            await ctx.send("📭 Выгружать нечего.")
+            return
+        if os.path.getsize(path) > ctx.guild.filesize_limit:
+            await ctx.send(f"⚠️ Выгрузка ({count} строк) больше лимита вложений сервера.")
+            return
+        await ctx.send(f"📦 {what}: {count} строк", file=discord.File(path, filename=f"{what}_{ctx.guild.id}.{fmt}"))
+    finally:
+        os.remove(path)
+
+def format_histogram(h: Histogram) -> str:
+    if not h.count:
+        return "нет данных"
+    return f"n={h.count}, среднее {h.sum / h.count * 1000:.0f} мс, p95 ≤ {h.quantile(0.95) * 1000:.0f} мс"
+
+@bot.command(name="stats")
+@ensure_allowed()
+async def stats_cmd(ctx: commands.Context):
+    """Сводка метрик процесса (то же, что отдаёт /metrics)."""
+    lines = [f"⏱ Опоздание планировщика: {format_histogram(metrics.histogram('bot_scheduler_lag_seconds'))}"]
+    for labels, h in sorted(metrics.histograms("bot_phase_seconds").items()):
+        lines.append(f"• {dict(labels)['phase']}: {format_histogram(h)}")
+    dm = {dict(labels)["status"]: int(v) for labels, v in metrics.counters("bot_dm_total").items()}
+    lines.append(
+        "✉️ ЛС: " + (", ".join(f"{k}={v}" for k, v in sorted(dm.items())) or "нет")
+        + f"; 429: {int(metrics.counter('bot_dm_ratelimit_total').value)}"
+    )
+    for op in ("read", "write"):
+        lines.append(f"🗄 БД {op}: {format_histogram(metrics.histogram('bot_db_seconds', op=op))}")
+    lines.append(
+        f"📋 Мастеров открыто: {metrics.gauge_value('bot_wizard_sessions'):g}, "
+        f"ЛС в очереди: {metrics.gauge_value('bot_outbox_pending'):g}, "
+        f"догоняющих: {metrics.gauge_value('bot_catchup_backlog'):g}"
+    )
+    await ctx.send("**Статистика:**\n" + "\n".join(lines))
+
+@bot.command(name="forecast")
+@ensure_allowed()
+async def forecast_cmd(ctx: commands.Context, days: Optional[float] = None):
+    """!forecast [дней] — где нагрузка на API превысит лимит ЛС."""
+    fc = await forecast_load(forecast_horizon(days))
+    horizon_days = len(fc.requests) / 1440
+    if not fc.requests.any():
+        await ctx.send(f"📈 За {horizon_days:g} дн. отправок не запланировано.")
+        return
+    peak = int(np.argmax(fc.requests))
+    lines = [
+        f"📈 Прогноз на {horizon_days:g} дн.: ЛС ~{fc.dms.sum():.0f}, пик {fc.requests[peak]:.0f} запросов/мин "
+        f"в {fc.at(peak):%Y-%m-%d %H:%M} UTC (лимит {fc.capacity:.0f}/мин)."
+    ]
+    hot = fc.hotspots(FORECAST_TOP)
+    if not hot:
+        lines.append("✅ Превышений лимита не ожидается.")
+    for m in hot:
+        here = fc.firing(m, ctx.guild.id)
+        lines.append(
+            f"⚠️ {fc.at(m):%Y-%m-%d %H:%M} — ЛС {fc.dms[m]:.0f}, запросов {fc.requests[m]:.0f}, "
+            f"хвост ~{fc.backlog[m] / fc.capacity:.0f} мин"
+            + (f"; здесь: ID {', '.join(map(str, here[:15]))}{' …' if len(here) > 15 else ''}" if here else "")
+        )
+    if fc.unknown:
+        lines.append(f"ℹ️ Для {fc.unknown} ролевых напоминаний индекс участников ещё не построен — их ЛС не учтены.")
+    await ctx.send("\n".join(lines)[:2000])
+
+# --------- Массовый импорт ----------
+CATCHUP_POLICIES = ("skip", "fire-once", "fire-all")
+INSERT_REMINDER = """INSERT INTO reminders
+    (guild_id, creator_id, kind, role_id, target_user_id, message, mode, run_at, weekly_days, weekly_time,
+     ack_required, catchup_policy, active, created_at, updated_at)
+    VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)"""
+
+def import_record(rec: dict, guild: discord.Guild, creator_id: int, now_iso: str) -> Tuple:
+    """Проверяет одну запись импорта (поля как в reminders) и возвращает параметры INSERT_REMINDER.
+    Ошибки — ValueError с понятным текстом."""
+    def field(name: str) -> str:
+        v = rec.get(name)
+        return "" if v is None else str(v).strip()
+
+    def int_field(name: str) -> int:
+        try:
+            return int(field(name))
+        except ValueError:
+            raise ValueError(f"{name}: ожидалось число")
+
+    kind = field("kind").lower()
+    role_id = target_user_id = None
+    if kind == "role":
+        role_id = int_field("role_id")
+        if guild.get_role(role_id) is None:
+            raise ValueError(f"роль {role_id} не найдена на сервере")
+    elif kind == "dm":
+        target_user_id = int_field("target_user_id")
+    else:
+        raise ValueError("kind: ожидалось `role` или `dm`")
+
+    message_text = field("message")
+    if not message_text:
+        raise ValueError("пустой message")
+
+    ack_required = 1 if field("ack_required").lower() in ("yes", "y", "да", "true", "1") else 0
+    policy = field("catchup_policy").lower() or None
+    if policy is not None and policy not in CATCHUP_POLICIES:
+        raise ValueError(f"catchup_policy: ожидалось одно из {', '.join(CATCHUP_POLICIES)}")
+
+    mode = field("mode").lower()
+    run_at_iso = weekly_days = weekly_time = None
+    if mode == "one":
+        try:
+            dt = dateparser.parse(field("run_at")).replace(second=0, microsecond=0)
+        except (ValueError, OverflowError):
+            raise ValueError("run_at: не удалось распарсить дату/время")
+        job_at = dt - timedelta(minutes=ACK_WINDOW_MINUTES) if ack_required else dt
+        if utc_timestamp(job_at) <= time.time():
+            raise ValueError("run_at уже прошло")
+        run_at_iso = dt.isoformat()
+    elif mode == "weekly":
+        days = normalize_days(field("weekly_days"))
+        if not days:
+            raise ValueError("weekly_days: не удалось распознать дни недели")
+        weekly_days = ",".join(days)
+        hh, mm = parse_hhmm(field("weekly_time"))
+        weekly_time = f"{hh:02d}:{mm:02d}"
+    else:
+        raise ValueError("mode: ожидалось `one` или `weekly`")
+
+    return (
+        guild.id, creator_id, kind, role_id, target_user_id, message_text, mode,
+        run_at_iso, weekly_days, weekly_time, ack_required, policy, 1, now_iso, now_iso,
+    )
+
+def import_lines(text: str, fmt: str) -> Iterator[Tuple[int, dict]]:
+    """(номер строки, запись) по одной; битая строка JSONL отдаётся как запись с ключом '_error'."""
+    if fmt == "csv":
+        reader = csv.DictReader(io.StringIO(text))
+        for rec in reader:
+            yield reader.line_num, rec
+        return
+    for n, line in enumerate(io.StringIO(text), start=1):
+        if not line.strip():
+            continue
+        try:
+            rec = json.loads(line)
+        except json.JSONDecodeError as e:
+            yield n, {"_error": f"JSON: {e.msg}"}
+            continue
+        yield n, rec if isinstance(rec, dict) else {"_error": "ожидался JSON-объект"}
+
+def insert_reminders(conn: sqlite3.Connection, records: List[Tuple]) -> List[sqlite3.Row]:
+    # писатель один, поэтому всё с id больше прежнего максимума — ровно наши строки
+    top = conn.execute("SELECT coalesce(max(id), 0) FROM reminders").fetchone()[0]
+    conn.executemany(INSERT_REMINDER, records)
+    return conn.execute("SELECT * FROM reminders WHERE id>? ORDER BY id", (top,)).fetchall()
+
+@bot.command(name="import")
+@ensure_allowed()
+async def import_cmd(ctx: commands.Context):
+    """!import с вложением .csv или .jsonl — поля как в reminders. Всё или ничего: при
+    ошибках ничего не сохраняется, выводится список строк с ошибками."""
+    if not ctx.message.attachments:
+        await ctx.send("Прикрепите файл `.csv` или `.jsonl` с напоминаниями.")
+        return
+    att = ctx.message.attachments[0]
+    fmt = att.filename.rsplit(".", 1)[-1].lower()
+    if fmt == "json":
+        fmt = "jsonl"
+    if fmt not in ("csv", "jsonl"):
+        await ctx.send("Поддерживаются только `.csv` и `.jsonl`.")
+        return
+    try:
+        text = (await att.read()).decode("utf-8-sig")
+    except UnicodeDecodeError:
+        await ctx.send("Файл должен быть в UTF-8.")
+        return
+
+    now_iso = datetime.utcnow().isoformat()
+    records: List[Tuple] = []
+    errors: List[str] = []
+    for n, rec in import_lines(text, fmt):
+        try:
+            if "_error" in rec:
+                raise ValueError(rec["_error"])
+            records.append(import_record(rec, ctx.guild, ctx.author.id, now_iso))
+        except ValueError as e:
+            errors.append(f"строка {n}: {e}")
+
+    if errors:
+        shown = "\n".join(errors[:20])
+        more = f"\n… и ещё {len(errors) - 20}" if len(errors) > 20 else ""
+        await ctx.send(f"❌ Импорт отменён, ошибок: {len(errors)}\n{shown}{more}")
+        return
+    if not records:
+        await ctx.send("📭 В файле нет записей.")
+        return
+
+    rows = await db.run_write(lambda conn: insert_reminders(conn, records))
+    schedule_reminders(rows)
+    await ctx.send(f"✅ Импортировано напоминаний: {len(rows)} (ID {rows[0]['id']}–{rows[-1]['id']}).")
+
+# --------- Мастер создания напоминания ---------
+class WizardSession:
+    """Один открытый мастер: ответы автора в этом канале приходят в ask()."""
+
+    def __init__(self, key: Tuple[int, int]) -> None:
+        self.key = key
+        self._inbox: Optional[asyncio.Future] = None
+
+    def deliver(self, message: discord.Message) -> None:
+        if self._inbox is not None and not self._inbox.done():
+            self._inbox.set_result(message)
+
+    async def ask(self, timeout: float) -> discord.Message:
+        """Ждёт следующее сообщение автора; asyncio.TimeoutError по истечении timeout."""
+        self._inbox = asyncio.get_running_loop().create_future()
+        try:
+            return await asyncio.wait_for(self._inbox, timeout=timeout)
+        finally:
+            self._inbox = None
+
+class WizardSessions:
+    """Диспетчер мастеров: каждое сообщение — один поиск в dict по (channel_id, author_id)
+    вместо прогона проверок всех ожидающих bot.wait_for."""
+
+    def __init__(self) -> None:
+        self._sessions: Dict[Tuple[int, int], WizardSession] = {}
+
+    def __len__(self) -> int:
+        return len(self._sessions)
+
+    def open(self, ctx: commands.Context) -> Optional[WizardSession]:
+        """None — у автора уже открыт мастер в этом канале."""
+        key = (ctx.channel.id, ctx.author.id)
+        if key in self._sessions:
+            return None
+        session = self._sessions[key] = WizardSession(key)
+        return session
+
+    def close(self, session: WizardSession) -> None:
+        if self._sessions.get(session.key) is session:
+            del self._sessions[session.key]
+
+    def route(self, message: discord.Message) -> None:
+        session = self._sessions.get((message.channel.id, message.author.id))
+        if session is not None:
+            session.deliver(message)
+
+wizard_sessions = WizardSessions()
+metrics.gauge("bot_wizard_sessions", lambda: len(wizard_sessions))
+
+@bot.command(name="reminder")
+@ensure_allowed()
+async def reminder_cmd(ctx: commands.Context):
+    session = wizard_sessions.open(ctx)
+    if session is None:
+        await ctx.send("У вас уже открыт мастер создания в этом канале.")
+        return
+    try:
+        await reminder_wizard(ctx, session)
+    finally:
+        wizard_sessions.close(session)
+
+async def reminder_wizard(ctx: commands.Context, session: WizardSession) -> None:
+    await ctx.send("Какой тип напоминания? Введите `role` или `dm`.")
+
+    try:
+        msg_kind = await session.ask(120.0)
+    except asyncio.TimeoutError:
+        await ctx.send("⏰ Время ожидания истекло.")
+        return
+
+    kind = msg_kind.content.strip().lower()
+    if kind not in ("role", "dm"):
+        await ctx.send("Нужно ввести `role` или `dm`.")
+        return
+
+    role_id = None
+    target_user_id = None
+
+    if kind == "role":
+        roles = [r for r in ctx.guild.roles if r != ctx.guild.default_role]
+        if not roles:
+            await ctx.send("На сервере нет ролей, кроме @everyone.")
+            return
+
+        options = [discord.SelectOption(label=r.name[:100], value=str(r.id)) for r in roles[:25]]  # Discord ограничение 25
+        select = Select(placeholder="Выберите роль для напоминания", min_values=1, max_values=1, options=options)
+
+        role_chosen: asyncio.Future = asyncio.get_running_loop().create_future()
+
+        async def on_select(interaction: discord.Interaction):
+            if interaction.user != ctx.author:
+                await interaction.response.send_message("Только инициатор может выбирать.", ephemeral=True)
+                return
+            chosen = int(select.values[0])
+            if not role_chosen.done():
+                role_chosen.set_result(chosen)
+            await interaction.response.edit_message(content=f"Выбрана роль: <@&{chosen}>", view=None)
+
+        view = View(timeout=120)
+        select.callback = on_select
+        view.add_item(select)
+        await ctx.send("Выберите роль:", view=view)
+
+        # ждём, пока пользователь выберет (future выставляет callback Select)
+        try:
+            role_id = await asyncio.wait_for(role_chosen, timeout=120)
+        except asyncio.TimeoutError:
             await ctx.send("⏰ Время выбора роли истекло.")
             return
     else:
         await ctx.send("Укажите пользователя (упоминание или ID).")
         try:
-            msg_user = await bot.wait_for("message", timeout=120.0, check=author_check)
+            msg_user = await session.ask(120.0)
         except asyncio.TimeoutError:
             await ctx.send("⏰ Время ожидания истекло.")
             return
@@ -450,7 +2764,7 @@ async def reminder_cmd(ctx: commands.Context):
 
     await ctx.send("Режим? Введите `one` (однократно) или `weekly` (по дням недели).")
     try:
-        msg_mode = await bot.wait_for("message", timeout=120.0, check=author_check)
+        msg_mode = await session.ask(120.0)
     except asyncio.TimeoutError:
         await ctx.send("⏰ Время ожидания истекло.")
         return
@@ -466,7 +2780,7 @@ async def reminder_cmd(ctx: commands.Context):
     if mode == "one":
         await ctx.send("Введите дату и время в формате `YYYY-MM-DD HH:MM` (например, `2025-08-15 18:00`). Время — по UTC.")
         try:
-            msg_dt = await bot.wait_for("message", timeout=180.0, check=author_check)
+            msg_dt = await session.ask(180.0)
             dt = dateparser.parse(msg_dt.content.strip())
             run_at_iso = dt.replace(second=0, microsecond=0).isoformat()
         except Exception:
@@ -475,7 +2789,7 @@ async def reminder_cmd(ctx: commands.Context):
     else:
         await ctx.send("Введите дни недели через запятую (напр. `mon,wed,fri` или `пн,ср,пт`).")
         try:
-            msg_days = await bot.wait_for("message", timeout=120.0, check=author_check)
+            msg_days = await session.ask(120.0)
         except asyncio.TimeoutError:
             await ctx.send("⏰ Время ожидания истекло.")
             return
@@ -487,7 +2801,7 @@ async def reminder_cmd(ctx: commands.Context):
 
         await ctx.send("Введите время в формате `HH:MM` (24ч, по UTC).")
         try:
-            msg_time = await bot.wait_for("message", timeout=120.0, check=author_check)
+            msg_time = await session.ask(120.0)
             hh, mm = parse_hhmm(msg_time.content.strip())
             weekly_time = f"{hh:02d}:{mm:02d}"
         except Exception as e:
@@ -496,7 +2810,7 @@ async def reminder_cmd(ctx: commands.Context):
 
     await ctx.send("Текст напоминания?")
     try:
-        msg_text = await bot.wait_for("message", timeout=240.0, check=author_check)
+        msg_text = await session.ask(240.0)
     except asyncio.TimeoutError:
         await ctx.send("⏰ Время ожидания истекло.")
         return
@@ -504,27 +2818,27 @@ async def reminder_cmd(ctx: commands.Context):
 
     await ctx.send("Включить проверку реакции ✅ перед ЛС? (`yes`/`no`)")
     try:
-        msg_ack = await bot.wait_for("message", timeout=120.0, check=author_check)
+        msg_ack = await session.ask(120.0)
     except asyncio.TimeoutError:
         await ctx.send("⏰ Время ожидания истекло.")
         return
     ack_required = 1 if msg_ack.content.strip().lower() in ("yes", "y", "да", "true", "1") else 0
 
     # Сохраняем в БД
-    db_execute(
+    now_iso = datetime.utcnow().isoformat()
+    new_id = await db_execute(
         """INSERT INTO reminders
-           (guild_id, creator_id, kind, role_id, target_user_id, message, mode, run_at, weekly_days, weekly_time, ack_required, active, created_at)
-           VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?)""",
+           (guild_id, creator_id, kind, role_id, target_user_id, message, mode, run_at, weekly_days, weekly_time, ack_required, active, created_at, updated_at)
+           VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?)""",
         (
             ctx.guild.id, ctx.author.id, kind,
             role_id, target_user_id,
             message_text, mode,
             run_at_iso, weekly_days, weekly_time,
-            ack_required, 1, datetime.utcnow().isoformat()
+            ack_required, 1, now_iso, now_iso
         )
     )
-    # Получим последнюю вставку
-    row = db_fetchone("SELECT * FROM reminders WHERE rowid = last_insert_rowid()")
+    row = await db_fetchone("SELECT * FROM reminders WHERE id=?", (new_id,))
     if not row:
         await ctx.send("❌ Не удалось создать напоминание.")
         return
@@ -533,3 +2847,5 @@ async def reminder_cmd(ctx: commands.Context):
     schedule_reminder(row)
     await ctx.send(f"✅ Напоминание создано")
 
+if __name__ == "__main__":
+    bot.run(TOKEN)
@@ -0,0 +1,105 @@
+"""Миграции схемы: доводят до последней версии и свежую БД, и БД исходной схемы,
+а горячие запросы после них идут по индексам."""
+import os
+import sqlite3
+
+import pytest
+
+os.environ.setdefault("DISCORD_TOKEN", "test")
+
+import bot  # noqa: E402
+
+# схема до появления миграций (user_version = 0)
+BASELINE_SCHEMA = """
+CREATE TABLE reminders (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    guild_id INTEGER NOT NULL,
+    creator_id INTEGER NOT NULL,
+    kind TEXT NOT NULL,
+    role_id INTEGER,
+    target_user_id INTEGER,
+    message TEXT NOT NULL,
+    mode TEXT NOT NULL,
+    run_at TEXT,
+    weekly_days TEXT,
+    weekly_time TEXT,
+    ack_required INTEGER NOT NULL,
+    active INTEGER NOT NULL DEFAULT 1,
+    created_at TEXT NOT NULL
+);
+CREATE TABLE history (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    reminder_id INTEGER NOT NULL,
+    sent_at TEXT NOT NULL,
+    dm_sent INTEGER NOT NULL,
+    details TEXT
+);
+CREATE TABLE allowed_users (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    guild_id INTEGER NOT NULL,
+    user_id INTEGER NOT NULL,
+    UNIQUE(guild_id, user_id)
+);
+INSERT INTO reminders(guild_id, creator_id, kind, role_id, message, mode, weekly_days, weekly_time, ack_required, created_at)
+    VALUES (7, 1, 'role', 70, 'hi', 'weekly', 'mon', '09:00', 1, '2025-01-01T00:00:00');
+INSERT INTO history(reminder_id, sent_at, dm_sent, details)
+    VALUES (1, '2025-01-06T09:00:00', 3, 'ack_msg_id=123 reacted=2');
+"""
+
+LATEST = bot.MIGRATIONS[-1][0]
+
+def _connect(path) -> sqlite3.Connection:
+    conn = sqlite3.connect(str(path))
+    conn.row_factory = sqlite3.Row
+    return conn
+
+@pytest.fixture
+def fresh_db(tmp_path):
+    conn = _connect(tmp_path / "fresh.db")
+    yield conn
+    conn.close()
+
+@pytest.fixture
+def baseline_db(tmp_path):
+    conn = _connect(tmp_path / "baseline.db")
+    conn.executescript(BASELINE_SCHEMA)
+    yield conn
+    conn.close()
+
+def _plan(conn: sqlite3.Connection, query: str) -> str:
+    params = (0,) * query.count("?")
+    return " | ".join(r["detail"] for r in conn.execute("EXPLAIN QUERY PLAN " + query, params))
+
+@pytest.fixture(params=["fresh_db", "baseline_db"])
+def migrated(request):
+    conn = request.getfixturevalue(request.param)
+    assert bot._apply_migrations(conn) == LATEST
+    return conn
+
+def test_reaches_latest_version(migrated):
+    assert migrated.execute("PRAGMA user_version").fetchone()[0] == LATEST
+    # повторный прогон ничего не делает
+    assert bot._apply_migrations(migrated) == LATEST
+
+def test_baseline_rows_are_backfilled(baseline_db):
+    bot._apply_migrations(baseline_db)
+    h = baseline_db.execute("SELECT guild_id, ack_message_id, reacted FROM history").fetchone()
+    assert tuple(h) == (7, 123, 2)
+    daily = baseline_db.execute("SELECT day, guild_id, reminder_id, sends, dm_sent, acks FROM history_daily").fetchone()
+    assert tuple(daily) == ("2025-01-06", 7, 1, 1, 3, 2)
+
+def test_list_query_uses_guild_active_index(migrated):
+    for query in bot.REMINDER_PAGES:
+        plan = _plan(migrated, query)
+        assert "idx_reminders_guild_active" in plan, plan
+        assert "TEMP B-TREE" not in plan, plan
+
+def test_load_query_uses_active_index(migrated):
+    plan = _plan(migrated, bot.ReminderLoader.LOAD_QUERY)
+    assert "idx_reminders_active" in plan, plan
+
+def test_history_query_uses_guild_sent_index(migrated):
+    for query in bot.HISTORY_PAGES:
+        plan = _plan(migrated, query)
+        assert "idx_history_guild_sent" in plan, plan
+        assert "TEMP B-TREE" not in plan, plan
@@ -0,0 +1,49 @@
+"""Оба движка планировщика должны понимать время одинаково — как UTC, независимо от зоны хоста."""
+import os
+import time
+import asyncio
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+os.environ.setdefault("DISCORD_TOKEN", "test")
+
+import bot  # noqa: E402
+
+@pytest.fixture
+def moscow_host(monkeypatch):
+    monkeypatch.setenv("TZ", "Europe/Moscow")
+    time.tzset()
+    yield
+    monkeypatch.undo()
+    time.tzset()
+
+async def _noop() -> None:
+    pass
+
+def _schedule(engine, run_naive: datetime, run_aware: datetime) -> dict:
+    async def run() -> dict:
+        engine.start()
+        try:
+            engine.at("naive", run_naive, _noop)
+            engine.at("aware", run_aware, _noop)
+            engine.weekly("weekly", ["mon", "thu"], 9, 30, _noop)
+            return {job_id: engine.next_run(job_id) for job_id in ("naive", "aware", "weekly")}
+        finally:
+            engine.shutdown()
+    return asyncio.run(run())
+
+def test_engines_agree_on_non_utc_host(moscow_host):
+    run_naive = (datetime.utcnow() + timedelta(days=2)).replace(second=0, microsecond=0)
+    run_aware = run_naive.replace(tzinfo=timezone.utc).astimezone(timezone(timedelta(hours=-5)))
+    expected = run_naive.replace(tzinfo=timezone.utc).timestamp()
+
+    aps = _schedule(bot.APSchedulerEngine(), run_naive, run_aware)
+    heap = _schedule(bot.HeapEngine(), run_naive, run_aware)
+
+    assert aps == heap
+    assert aps["naive"] == expected
+    assert aps["aware"] == expected
+    weekly = datetime.fromtimestamp(aps["weekly"], timezone.utc)
+    assert (weekly.strftime("%a"), weekly.hour, weekly.minute) in {("Mon", 9, 30), ("Thu", 9, 30)}
+    assert weekly > datetime.now(timezone.utc)